@@ -19,6 +19,7 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import re
 import time
 import globals as G
 
@@ -28,14 +29,15 @@ from gi.repository import GObject
 
 from widgets import View
 from widgets import InfoBar
-from widgets import IconView
-from widgets import ListView
 from widgets import Notebook
 from widgets import PlaceBox
 from widgets import StatusBar
 from widgets import SearchEntry
+from widgets import FuzzyFinder
 from widgets import LateralView
 from widgets import MkdirInfoBar
+from widgets import SearchInfoBar
+from widgets import ResumeInfoBar
 from widgets import TrashInfoBar
 from widgets import ProgressWindow
 from widgets import PropertiesWindow
@@ -49,6 +51,7 @@ class CExplorer(Gtk.Window):
         self.dirs = G.Dirs()
         self.folder = G.HOME_DIR
         self.folder_name = self.dirs[self.folder]
+        self.recent_folders = []
         self.other_view = False
         self.view = None
         self.icon_size = G.DEFAULT_ICON_SIZE
@@ -56,7 +59,8 @@ class CExplorer(Gtk.Window):
         self.shortcut = ''
         self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
         self.ccpmanager = G.CCPManager()
-        self.trash_manager = G.TrashManager()
+        self.trash_manager = G.TrashManager(self.ccpmanager)
+        self.file_index = G.FileIndex() if G.INDEX_FILES else None
         self.progress_window = ProgressWindow(self.ccpmanager)
         self.actions = None
 
@@ -76,8 +80,6 @@ class CExplorer(Gtk.Window):
         self.notebook.connect('switch-page', self.__switch_page)
         self.notebook.connect('new-page', lambda w, p: self.new_page(p))
         self.notebook.connect('remove-page', self.__remove_page_from_notebook)
-        self.notebook.connect(
-            'reconnect-all-views', self.__reconnect_all_views)
         self.paned.pack2(self.notebook, True)
 
         self.place_box = PlaceBox()
@@ -107,21 +109,40 @@ class CExplorer(Gtk.Window):
         self.search_entry.connect('search-changed', self.search_item)
         self.search_entry.connect('select', self.__open_selected_items)
 
+        self.fuzzy_finder = FuzzyFinder()
+        self.fuzzy_finder.connect('item-selected', self.__jump_to_item)
+
         self.connect('destroy', self._exit)
         self.connect('realize', self.__realize_cb)
         self.connect('key-press-event', self.__key_press_event_cb)
         self.connect('key-release-event', self.__key_release_event_cb)
-        self.ccpmanager.connect('start', self.__add_new_ccp_operation)
+        self.ccpmanager.connect('added', self.__add_new_ccp_operation)
         self.trash_manager.connect('files-changed', self.__show_trash_files)
+        self.trash_manager.connect('sizes-changed', self.__update_trash_size)
 
         self.make_actions()
 
+        if self.file_index:
+            self.file_index.start()
+
+        journals = self.ccpmanager.get_interrupted_operations()
+        if journals:
+            infobar = ResumeInfoBar(len(journals))
+            infobar.connect('resume', self.__resume_operations, journals)
+            infobar.connect('discard', self.__discard_operations, journals)
+            self.vbox.pack_start(infobar, False, False, 0)
+            self.vbox.reorder_child(infobar, 0)
+
         self.add(self.vbox)
         self.show_all()
 
     def set_folder(self, folder):
         readable, writable = G.get_access(folder)
-        if readable and os.path.isdir(folder):
+        if readable and os.path.isdir(folder) and self.view_shows_results():
+            self.new_page(folder)
+            return
+
+        elif readable and os.path.isdir(folder):
             self.folder = folder
             self.get_actual_view().folder = folder
             self.place_box.set_folder(folder)
@@ -141,6 +162,10 @@ class CExplorer(Gtk.Window):
 
         GObject.idle_add(self.update_widgets, force=False)
 
+    def view_shows_results(self):
+        idx = self.notebook.get_current_page()
+        return self.notebook.get_children()[idx].results
+
     def show_and_hide_files(self):
         self.scan_folder.set_show_hidden_files(
             not self.scan_folder.show_hidden_files)
@@ -150,7 +175,18 @@ class CExplorer(Gtk.Window):
         view.select_all()
 
     def search_files(self):
-        print 'Search files'
+        view = self.new_page(self.folder)
+        view.results = True
+
+        infobar = SearchInfoBar()
+        infobar.connect('search', self.__start_search, view)
+        infobar.connect('stop', self.__stop_search, view)
+        view.pack_start(infobar, False, False, 0)
+        view.reorder_child(infobar, 0)
+
+        view.clear_model()
+        view.restore_selection()
+        self.notebook.update_tab_labels()
 
     def new_window(self):
         print 'New window'
@@ -160,8 +196,9 @@ class CExplorer(Gtk.Window):
                         'Ctrl+w': (self.remove_page, (None, None, True,)),
                         'Ctrl+t': (self.new_page, ()),
                         'Ctrl+h': (self.show_and_hide_files, ()),
-                        'Ctrĺ+a': (self.select_all_items, ()),
-                        'Ctrĺ+f': (self.search_files, ()),
+                        'Ctrl+a': (self.select_all_items, ()),
+                        'Ctrl+f': (self.search_files, ()),
+                        'Ctrl+p': (self.quick_jump, ()),
                         'Ctrl+n': (self.new_window, ()),
                         'Ctrl++': (self.statusbar.aument, ()),
                         'Ctrl+-': (self.statusbar.disminuit, ()),
@@ -202,24 +239,22 @@ class CExplorer(Gtk.Window):
         self.shortcut = ''
         self.pressed_keys = []
 
-    def search_item(self, window, text):
-        tildes = {'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u'}
-        text = text.lower()
+    def quick_jump(self):
         view = self.get_actual_view()
-        view.view.unselect_all()
-
-        for tilde in tildes:
-            text = text.replace(tilde, tildes[tilde])
+        folders = [x for x in self.recent_folders if x not in view.rows]
+        self.fuzzy_finder.set_paths(view.paths + folders, view.folder)
 
-        for item in view.model:
-            label = list(item)[0].lower()
-
-            for tilde in tildes:
-                label = label.replace(tilde, tildes[tilde])
+        x, y = self.get_position()
+        width, height = self.get_size()
+        self.fuzzy_finder.move(x + (width - self.fuzzy_finder.width) / 2,
+                               y + 60)
+        self.fuzzy_finder._show('')
+        self.shortcut = ''
+        self.pressed_keys = []
 
-            if label.lower().startswith(text.lower()):
-                view.view.select_path(item.path)
-                break
+    def search_item(self, window, text):
+        view = self.get_actual_view()
+        view.select_path(view.name_index.find(text))
 
     def remove_page(self, idx=None, view=None, close=False):
         if not view:
@@ -228,6 +263,9 @@ class CExplorer(Gtk.Window):
 
             view = self.notebook.get_children()[idx]
 
+        if view.search:
+            view.search.cancel()
+
         self.notebook.remove(view)
         if not self.notebook.get_children() and not close:
             self.new_page()
@@ -256,28 +294,37 @@ class CExplorer(Gtk.Window):
         view.connect('reverse-changed', self.__reverse_changed)
         view.connect('show-properties', self.show_properties_for_paths)
         view.connect('mkdir', self.__show_mkdir_infobar)
+        view.connect('cut', self.cut_from_view)
         view.connect('copy', self.copy_from_view)
         view.connect('paste', self.paste_from_view)
         view.connect('move-to-trash', self.__move_to_trash)
         view.connect('remove-files', self.__remove)
 
+        return view
+
+    def cut_from_view(self, view, paths):
+        self.set_clipboard(G.CUT, paths)
+
     def copy_from_view(self, view, paths):
-        text = 'COPY\n'
+        self.set_clipboard(G.COPY, paths)
+
+    def paste_from_view(self, view, folder):
+        self.paste(folder)
+
+    def set_clipboard(self, action, paths):
+        text = 'CUT\n' if action == G.CUT else 'COPY\n'
         for path in paths:
             text += path + '\n'
 
         self.clipboard.set_text(text, -1)
 
-    def paste_from_view(self, view, folder):
-        self.paste()
-
     def cut(self):
         view = self.get_actual_view()
-        self.clipborad = (G.CUT, view.get_selected_paths())
+        self.set_clipboard(G.CUT, view.get_selected_paths())
 
     def copy(self):
         view = self.get_actual_view()
-        self.clipborad = (G.COPY, view.get_selected_paths())
+        self.set_clipboard(G.COPY, view.get_selected_paths())
 
     def paste(self, destination=None):
         text = self.clipboard.wait_for_text()
@@ -291,9 +338,11 @@ class CExplorer(Gtk.Window):
 
         if lines[0] == 'COPY':
             action = G.COPY
+            lines = lines[1:]
 
         elif lines[0] == 'CUT':
             action = G.CUT
+            lines = lines[1:]
 
         else:
             action = G.COPY
@@ -302,16 +351,25 @@ class CExplorer(Gtk.Window):
         time_id = time.time()
 
         for line in lines:
-            if not '/' in line:  # The text coppied aren't files
-                return
-
-            if path.startswith('file:///'):
+            if line.startswith('file:///'):
                 line = line[7:]  # len('file://') = 7
 
+            if not line.startswith('/'):  # The text coppied aren't files
+                return
+
             paths.append(line)
 
-        m = G.CCPManager()
-        m.add_action(action, paths, directory, time_id)
+        readable, writable = G.get_access(destination)
+        if not writable:
+            self.infobar.set_msg(G.ERROR_NOT_UNWRITABLE, destination)
+            self.infobar.show_all()
+            return
+
+        self.ccpmanager.add_action(action, paths, destination, time_id)
+
+        if action == G.CUT:
+            # The files no longer are in their old folder
+            self.clipboard.clear()
 
     def show_properties_for_paths(self, view, paths):
         if not paths:
@@ -338,6 +396,13 @@ class CExplorer(Gtk.Window):
 
         self.other_view = True
         self.folder = view.folder
+        if not view.results:
+            if view.folder in self.recent_folders:
+                self.recent_folders.remove(view.folder)
+
+            self.recent_folders.insert(0, view.folder)
+            del self.recent_folders[G.RECENT_FOLDERS_MAX:]
+
         other_folder = view.folder != G.SYSTEM_DIR
         is_trash = G.clear_path(view.folder) == G.clear_path(G.TRASH_DIR)
 
@@ -354,6 +419,7 @@ class CExplorer(Gtk.Window):
 
     def update_icons(self, scan_folder, paths):
         view = self.get_actual_view()
+        self.statusbar.refresh()
         GObject.idle_add(view.show_icons, paths)
 
     def get_actual_view(self):
@@ -425,6 +491,61 @@ class CExplorer(Gtk.Window):
         self.vbox.pack_start(infobar, False, False, 0)
         self.vbox.reorder_child(infobar, 0)
 
+    def __start_search(self, infobar, text, mode, content, other_devices,
+                       depth, view):
+
+        self.__stop_search(infobar, view)
+
+        try:
+            if content:
+                search = G.ContentSearch(
+                    view.folder, text, mode, same_mount=not other_devices,
+                    show_hidden_files=self.scan_folder.show_hidden_files)
+
+            else:
+                search = G.FileSearch(
+                    view.folder, text, mode, max_depth=depth or None,
+                    same_mount=not other_devices,
+                    show_hidden_files=self.scan_folder.show_hidden_files)
+
+        except re.error:
+            self.infobar.set_msg(G.ERROR_INVALID_PATTERN, text)
+            self.infobar.show_all()
+            return
+
+        view.search = search
+        view.clear_model()
+        view.restore_selection()
+
+        if self.file_index and not content and not depth:
+            paths = self.file_index.query(
+                text, mode, view.folder, self.scan_folder.show_hidden_files)
+
+            if paths is not None:
+                view.add_paths(paths)
+                self.notebook.update_tab_labels()
+                return
+
+        if content:
+            search.connect(
+                'results-found', lambda s, matches: view.add_matches(matches))
+
+        else:
+            search.connect(
+                'results-found', lambda s, paths: view.add_paths(paths))
+
+        search.connect('finished', lambda s: infobar.set_searching(False))
+        infobar.set_searching(True)
+        search.start()
+
+        self.notebook.update_tab_labels()
+
+    def __stop_search(self, infobar, view):
+        if view.search:
+            view.search.cancel()
+
+        infobar.set_searching(False)
+
     def __change_view_mode(self, place_box, mode):
         self.mode = mode
         self.notebook.set_view_mode(mode)
@@ -434,51 +555,31 @@ class CExplorer(Gtk.Window):
 
     def __open_selected_items(self, widget):
         view = self.get_actual_view()
-        paths = []
 
         if widget == self.search_entry:
             self.shortcut = ''
             self.pressed_keys = []
 
-        for _path in view.view.get_selected_items():
-            item = view.model.get_iter(_path)
-            name = view.model.get_value(item, 0)
-            path = os.path.join(view.folder, name)
-            paths.append(path)
+        self.__item_selected(None, view.get_selected_paths())
 
-        self.__item_selected(None, paths)
+    def __jump_to_item(self, finder, path):
+        if os.path.isdir(path):
+            self.set_folder(path)
+
+        else:
+            self.get_actual_view().select_path(path)
 
     def __remove_page_from_notebook(self, notebook, view):
         idx = self.notebook.get_children().index(view)
         self.remove_page(idx)
 
-    def __reconnect_all_views(self, notebook):
-        for view in self.notebook.get_children():
-            view.icon_size = self.icon_size
-            view.connect('selection-changed', self.__update_statusbar)
-            view.connect('item-selected', self.__item_selected)
-            view.connect('item-selected',
-                         lambda *args: self.notebook.update_tab_labels())
-            view.connect('new-page', lambda x, p: self.new_page(p))
-            view.connect('sort-changed', self.__sort_changed)
-            view.connect('reverse-changed', self.__reverse_changed)
-            view.connect('show-properties', self.show_properties_for_paths)
-            view.connect('copy', self.copy)
-            view.connect('paste', self.paste)
-            view.connect('move-to-trash', self.__move_to_trash)
-            view.connect('remove-files', self.__remove)
-
     def __icon_size_changed(self, widget, value):
         self.icon_size = value
         for view in self.notebook.get_children():
             GObject.idle_add(view.set_icon_size, value)
 
     def __update_statusbar(self, view=None, selected=[]):
-        if selected:
-            self.statusbar.update_label(selected, self.folder)
-
-        else:
-            self.statusbar.label.set_label(self.folder)
+        self.statusbar.update_label(selected, self.folder)
 
     def __show_trash(self, lateral_view):
         view = self.get_actual_view()
@@ -501,13 +602,21 @@ class CExplorer(Gtk.Window):
         self.trash_manager.start()
 
     def __show_trash_files(self, trash_manager, files):
-        paths = []
+        paths = [data['real-file']
+                 for data in self.trash_manager.files.values()]
+
         for view in self.notebook.get_children():
             if G.clear_path(view.folder) == G.clear_path(G.TRASH_DIR):
-                for path, data in self.trash_manager.files.items():
-                    paths.append(data['real-file'])
+                view.show_icons(paths)
 
-                    view.show_icons(paths)
+        self.__update_trash_size()
+
+    def __update_trash_size(self, trash_manager=None):
+        for view in self.notebook.get_children():
+            for child in view.get_children():
+                if isinstance(child, TrashInfoBar):
+                    child.set_size(len(self.trash_manager.files),
+                                   self.trash_manager.get_total_size())
 
     def __move_to_trash(self, view, paths):
         self.trash_manager.move_to(paths)
@@ -559,6 +668,12 @@ class CExplorer(Gtk.Window):
         except:
             print 'error'
 
+    def __resume_operations(self, infobar, journals):
+        self.ccpmanager.resume_operations(journals)
+
+    def __discard_operations(self, infobar, journals):
+        self.ccpmanager.discard_operations(journals)
+
     def __add_new_ccp_operation(self, ccpmanager, time_id):
         self.progress_window.add_operation(time_id)
 
@@ -568,5 +683,6 @@ class CExplorer(Gtk.Window):
 
 
 if __name__ == '__main__':
+    G.start_search_pool()  # Before any thread is started
     CExplorer()
     Gtk.main()
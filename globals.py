@@ -18,12 +18,36 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import io
 import os
 import re
+import stat
 import time
+import mmap
+import fcntl
+import struct
+import json
+import zlib
+import urllib
+import tempfile
+import errno
+import ctypes
+import shutil
+import Queue
+import array
+import heapq
+import hashlib
+import bisect
 import thread
+import fnmatch
 import datetime
+import platform
+import sre_parse
+import sre_constants
+import unicodedata
+import ctypes.util
 import subprocess
+import multiprocessing
 import ConfigParser
 from gettext import gettext as _
 
@@ -34,6 +58,71 @@ from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import GdkPixbuf
 
+try:
+    from os import scandir
+
+except ImportError:
+    try:
+        from scandir import scandir
+
+    except ImportError:
+        scandir = None
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+except OSError:
+    libc = None
+
+if libc is not None and hasattr(libc, 'copy_file_range'):
+    libc.copy_file_range.restype = ctypes.c_ssize_t
+    libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_size_t, ctypes.c_uint]
+
+if libc is not None and hasattr(libc, 'syscall'):
+    libc.syscall.restype = ctypes.c_long
+
+if libc is not None and hasattr(libc, 'syncfs'):
+    libc.syncfs.argtypes = [ctypes.c_int]
+
+if libc is not None and hasattr(libc, 'posix_fadvise'):
+    libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                   ctypes.c_longlong, ctypes.c_int]
+
+if libc is not None and hasattr(libc, 'sendfile'):
+    libc.sendfile.restype = ctypes.c_ssize_t
+    libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                              ctypes.c_size_t]
+
+
+class Dirent(ctypes.Structure):
+    # struct dirent of glibc in 64 bits
+    _fields_ = [('d_ino', ctypes.c_uint64),
+                ('d_off', ctypes.c_int64),
+                ('d_reclen', ctypes.c_ushort),
+                ('d_type', ctypes.c_ubyte),
+                ('d_name', ctypes.c_char * 256)]
+
+
+# Without scandir, the folders are listed with readdir, that gives the type
+# of the entries without a lstat for each one.
+readdir = None
+if libc is not None and platform.system() == 'Linux' and \
+        platform.machine() in ('x86_64', 'aarch64'):
+    libc.opendir.restype = ctypes.c_void_p
+    libc.opendir.argtypes = [ctypes.c_char_p]
+    libc.readdir.restype = ctypes.POINTER(Dirent)
+    libc.readdir.argtypes = [ctypes.c_void_p]
+    libc.closedir.argtypes = [ctypes.c_void_p]
+    readdir = libc.readdir
+
+# The processes of ContentSearch, started by start_search_pool, and a flag
+# for each search that they check to skip the files of cancelled searchs.
+search_pool = None
+search_cancelled = None
+search_count = 0
+
 
 TILDES = {'%C3%81': 'Á',
           '%C3%89': 'É',
@@ -71,12 +160,14 @@ ERROR_NOT_UNWRITABLE = 1
 ERROR_ALREADY_EXISTS = 2
 ERROR_INVALID_NAME = 3
 ERROR_NOT_EXISTS = 4
+ERROR_INVALID_PATTERN = 5
 
 TITLE_ERROR_UNREADABLE = _('Could not be displayed here.')
 TITLE_ERROR_UNWRITABLE = _('Could not be set.')
 TITLE_ERROR_ALREADY_EXISTS = _('Could not rename.')
 TITLE_ERROR_INVALID_NAME = _('Could not rename.')
 TITLE_ERROR_NOT_EXISTS = _('Could not be displayed here.')
+TITLE_ERROR_INVALID_PATTERN = _('Could not search.')
 
 MSG_UNREADABLE = _(
     'You do not have sufficient permissions to view the content of "@".')
@@ -84,6 +175,8 @@ MSG_UNWRITABLE = _('You do not have sufficient permissions to edit "@".')
 MSG_ALREADY_EXISTS = _('You can not rename to "@", because already exists.')
 MSG_INVALID_NAME = _('"@"" is a invalid name for a file.')
 MSG_NOT_EXISTS = _('"@" can not be displayed because it does not exist.')
+MSG_INVALID_PATTERN = _('"@" is a invalid search pattern.')
+MSG_VERIFY_FAILED = _('The copy is different from the original')
 
 SORT_BY_NAME = 0
 SORT_BY_SIZE = 1
@@ -91,8 +184,82 @@ SORT_BY_SIZE = 1
 MODE_ICONS = 0
 MODE_LIST = 1
 
+SEARCH_SUBSTRING = 0
+SEARCH_GLOB = 1
+SEARCH_REGEX = 2
+
+CONTENT_SEARCH_MAX_SIZE = 64 * 1024 * 1024
+CONTENT_SEARCH_MAX_MATCHES = 100  # For each file
+CONTENT_SEARCH_LIMIT = 10000
+CONTENT_SEARCH_SLOTS = 64  # Searchs that can be cancelled at the same time
+
+RECENT_FOLDERS_MAX = 50
+FUZZY_MAX_CANDIDATES = 1000  # Scored for each text
+
 CUT = 'mv'
 COPY = 'cp'
+REMOVE = 'rm'
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+COPY_PROGRESS_INTERVAL = 0.1  # Seconds
+COPY_PARALLEL = True
+COPY_WORKERS_PER_DEVICE = 4
+COPY_QUEUE_SIZE = 1000
+COPY_JOURNAL_INTERVAL = 1  # Seconds between the offsets saved for a file
+# copy_file_range and sendfile fail with these errors when they can not be
+# used with a file (or with these file systems), so the data is copied
+# with read and write.
+COPY_FALLBACK_ERRORS = [errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF]
+# Reflinks (btrfs, XFS): the copy shares the blocks of the original file
+COPY_CLONE = True
+FICLONE = 0x40049409
+FICLONERANGE = 0x4020940d
+CLONE_FALLBACK_ERRORS = COPY_FALLBACK_ERRORS + [errno.ENOTTY, errno.EPERM,
+                                                errno.ETXTBSY]
+# The copies are read again from the device and compared with the hash of
+# the data read from the originals
+COPY_VERIFY = False
+COPY_VERIFY_HASH = 'sha1'
+POSIX_FADV_DONTNEED = 4
+# When the copies are written to the device: never forced, with a syncfs
+# of the destination at the end of the operation, or with a fdatasync for
+# each file.
+DURABILITY_NONE = 0
+DURABILITY_SYNCFS = 1
+DURABILITY_FDATASYNC = 2
+DURABILITY_NAMES = {DURABILITY_NONE: _('not synced'),
+                    DURABILITY_SYNCFS: _('synced at the end'),
+                    DURABILITY_FDATASYNC: _('each file synced')}
+COPY_DURABILITY = DURABILITY_SYNCFS
+COPY_RATE_LIMIT = 0  # Bytes per second for all the operations, 0 = no limit
+COPY_RATE_CHUNK_TIME = 0.1  # Seconds of data in a chunk with a rate limit
+COPY_MIN_CHUNK_SIZE = 4096
+COPY_IDLE_PRIORITY = False
+# Syscall numbers of ioprio_set and gettid
+IOPRIO_SYSCALLS = {'x86_64': (251, 186),
+                   'i386': (289, 224),
+                   'i686': (289, 224),
+                   'armv7l': (314, 224),
+                   'aarch64': (30, 178)}
+IOPRIO_WHO_PROCESS = 1
+DT_UNKNOWN = 0
+DT_DIR = 4
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+# The files with several hard links are copied once and linked again
+COPY_HARDLINKS = True
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+COPY_STRATEGIES = {'rename': _('renamed'),
+                   'reflink': _('cloned'),
+                   'copy_file_range': _('copied in the kernel'),
+                   'sendfile': _('copied in the kernel'),
+                   'buffer': _('copied'),
+                   'sparse': _('holes kept'),
+                   'hardlink': _('hard links kept'),
+                   'verify': _('verified')}
 
 ACTIVATION_WITH_A_CLICK = 'GDK_BUTTON_PRESS'
 ACTIVATION_WITH_TWO_CLICKS = 'GDK_2BUTTON_PRESS'
@@ -120,6 +287,16 @@ SYSTEM_NAME = _('Equipment')
 TRASH_DIR = os.path.expanduser('~/.local/share/Trash/files/')
 TRASH_NAME = _('Trash')
 TRASH_INFO_DIR = os.path.expanduser('~/.local/share/Trash/info/')
+TRASH_STAGING_PREFIX = '.expunged-'
+TRASH_PARENT_DIR = os.path.dirname(os.path.dirname(TRASH_DIR.rstrip('/')))
+CACHE_DIR = os.path.expanduser('~/.cache/cexplorer/')
+
+JOURNAL_DIR = os.path.join(CACHE_DIR, 'operations/')
+
+INDEX_FILES = False  # Optional, the index is kept in memory
+INDEX_FILE = os.path.join(CACHE_DIR, 'files.index')
+INDEX_MAX_ENTRIES = 4000000
+INDEX_UPDATE_INTERVAL = 30 * 60 * 1000  # 30 minutes
 
 
 KEYS = {65288: 'Backspace',
@@ -228,365 +405,3280 @@ class Dirs(object):
                     cfg = ConfigParser.ConfigParser()
                     cfg.read([path])
 
-                    if cfg.has_option('Desktop Entry', 'Name'):
-                        return cfg.get('Desktop Entry', 'Name')
+                    if cfg.has_option('Desktop Entry', 'Name'):
+                        return cfg.get('Desktop Entry', 'Name')
+
+                return get_name(path)
+
+    def __setitem__(self, name, value):
+        if not name in self[name]:
+            if '/' in name:
+                self.dirs.append(name)
+                self.names.append(value)
+
+            else:
+                self.names.append(name)
+                self.dirs.append(value)
+
+        else:
+            if name in self.dirs:
+                self.names[self.dirs.index(name)] = value
+
+            elif name in self.names:
+                self.dirs[self.names.index(name)] = value
+
+    def __iter__(self):
+        for x in self.dirs:
+            yield x
+
+    def __contains__(self, name):
+        if name in self.dirs + self.names:
+            return True
+
+        if clear_path(name) in self.mounts:
+            return True
+
+        for x in self.dirs:
+            if not x.endswith('/'):
+                x += '/'
+
+            if not name.endswith('/'):
+                name += '/'
+
+            if name == x:
+                return True
+
+        return False
+
+    def get_pixbuf_symbolic(self, path):
+        screen = Gdk.Screen.get_default()
+        icon_theme = Gtk.IconTheme.get_for_screen(screen)
+        return icon_theme.load_icon(
+            self.symbolic_icons[path], DEFAULT_ITEM_ICON_SIZE, 0)
+
+    def add_mount(self, path):
+        if not clear_path(path) in self.mounts:
+            self.mounts.append(clear_path(path))
+
+    def remove_mount(self, path):
+        if clear_path(path) in self.mounts:
+            self.mounts.remove(clear_path(path))
+
+
+class NameIndex(object):
+    """
+    Keeps the normalized names of a listing sorted, so the items that starts
+    with some text can be found with a binary search:
+
+    >>> index = NameIndex()
+    >>> index.update(['/tmp/Árbol', '/tmp/casa'], get_name)
+    >>> print index.find('arb')
+    ... /tmp/Árbol
+    """
+
+    def __init__(self):
+        self.keys = []  # Sorted list of (normalized name, path)
+        self.names = {}  # {path: normalized name}
+
+    def update(self, paths, get_name):
+        # Only the added items are normalized, get_name is called for them.
+        paths = set(paths)
+        removed = [x for x in self.names if not x in paths]
+        added = [x for x in paths if not x in self.names]
+
+        for path in removed:
+            key = (self.names.pop(path), path)
+            idx = bisect.bisect_left(self.keys, key)
+            if idx < len(self.keys) and self.keys[idx] == key:
+                del self.keys[idx]
+
+        for path in added:
+            self.names[path] = normalize_name(get_name(path))
+
+        if len(added) > len(self.keys) / 4:
+            self.keys.extend([(self.names[x], x) for x in added])
+            self.keys.sort()
+
+        else:
+            for path in added:
+                bisect.insort(self.keys, (self.names[path], path))
+
+    def find(self, text):
+        text = normalize_name(text)
+        idx = bisect.bisect_left(self.keys, (text,))
+        if idx < len(self.keys) and self.keys[idx][0].startswith(text):
+            return self.keys[idx][1]
+
+        return None
+
+    def clear(self):
+        self.keys = []
+        self.names = {}
+
+
+class FuzzyMatcher(object):
+    """
+    Ranks paths by how well a text matches them as a subsequence, like fzf.
+
+    The candidates are kept in a string separated by new lines, and they are
+    filtered with regular expressions from the best kind of match to the
+    worst (the text at the start of a word of the name, inside the name,
+    anywhere, then each character at the start of a word, and as a
+    subsequence of the name and of the path). Only
+    the first FUZZY_MAX_CANDIDATES lines found are scored with fuzzy_score,
+    and the best ones are kept in a heap.
+    """
+
+    def __init__(self, paths=[], folder=''):
+        self.set_paths(paths, folder)
+
+    def set_paths(self, paths, folder=''):
+        # The paths inside folder are matched by their relative path.
+        self.paths = list(paths)
+        self.keys = []
+        folder = folder.rstrip('/') + '/' if folder else ''
+        for path in self.paths:
+            if folder and path.startswith(folder):
+                path = '/' + path[len(folder):]
+
+            self.keys.append(path.rstrip('/').lower())
+
+        self.blob = '\n'.join(self.keys) + '\n'
+        self.offsets = array.array('l')
+
+        position = 0
+        for key in self.keys:
+            self.offsets.append(position)
+            position += len(key) + 1
+
+    def search(self, text, limit=50):
+        text = text.lower()
+        if not text:
+            return self.paths[:limit]
+
+        candidates = self.__get_candidates(text)
+        scores = self.__score(text, candidates)
+        return [self.paths[x[2]] for x in heapq.nlargest(limit, scores)]
+
+    def __get_candidates(self, text):
+        # The lines found by each expression, until there are enough. The
+        # lookbehinds go after a literal, so re can look for the literal.
+        subsequence = self.__get_subsequence(text)
+        if not re.search(subsequence, self.blob):
+            return []
+
+        regexes = []
+        if text in self.blob:
+            literal = re.escape(text)
+            regexes += [r'%s(?<=[/ _.\-]%s)[^\n/]*$' % (literal, literal),
+                        r'%s[^\n/]*$' % literal,
+                        literal]
+
+        first = re.escape(text[0])
+        regexes += [first + r'(?<=[/ _.\-]%s)' % first + ''.join(
+                        [r'[^\n]*?[/ _.\-]' + re.escape(x) for x in text[1:]]),
+                    self.__get_subsequence(text, '/') + '[^\n/]*$',
+                    subsequence]
+
+        candidates = []
+        found = set()
+        for regex in regexes:
+            last = -1
+            for match in re.finditer(regex, self.blob, re.MULTILINE):
+                idx = bisect.bisect_right(self.offsets, match.start()) - 1
+                if idx == last or idx in found:
+                    continue  # Other match in the same line
+
+                last = idx
+                found.add(idx)
+                candidates.append(idx)
+                if len(candidates) == FUZZY_MAX_CANDIDATES:
+                    return candidates
+
+        return candidates
+
+    def __score(self, text, candidates):
+        # Yields (score, -length, index) of each candidate
+        for idx in candidates:
+            score = fuzzy_score(text, self.keys[idx])
+            if score is not None:
+                yield score, -len(self.keys[idx]), idx
+
+    def __get_subsequence(self, text, exclude=''):
+        # Each gap can not contain the next character, so the regular
+        # expression never goes back. The gaps neither contain exclude.
+        regex = re.escape(text[0])
+        for char in text[1:]:
+            char = re.escape(char)
+            regex += '[^\n%s%s]*%s' % (exclude, char, char)
+
+        return regex
+
+
+class ScanFolder(GObject.GObject):
+
+    __gsignals__ = {
+        'files-changed': (GObject.SIGNAL_RUN_FIRST, None, [object]),
+        'realized-searching': (GObject.SIGNAL_RUN_FIRST, None, []),
+        }
+
+    def __init__(self, folder, timeout=500):
+
+        GObject.GObject.__init__(self)
+
+        self.folder = folder
+        self.files = []
+        self.show_hidden_files = False
+        self.can_scan = True
+        self.mounts = {}
+
+        GObject.timeout_add(timeout, self.scan)
+
+    def scan(self, force=False):
+        if not self.can_scan:
+            return True
+
+        files = []
+        directories = []
+
+        if (self.files != self.get_files()) or force:
+            self.files = self.get_files()
+
+            self.emit('files-changed', self.files)
+
+        self.emit('realized-searching')
+
+        return True
+
+    def set_folder(self, folder):
+        self.folder = folder
+        GObject.idle_add(self.scan)
+
+    def get_files(self):
+        directories = []
+        files = []
+        if os.path.isdir(self.folder):
+            _files = os.listdir(self.folder)
+
+        else:
+            self.folder = get_parent_directory(self.folder)
+            return
+
+        for name in _files:
+            filename = clear_path(os.path.join(self.folder, name))
+
+            if (not name.startswith('.') and not name.endswith('~')) or \
+                    self.show_hidden_files:
+
+                if os.path.isdir(filename):
+                    directories.append(filename)
+
+                elif os.path.isfile(filename):
+                    files.append(filename)
+
+        directories = natural_sort(directories)
+        files = natural_sort(files)
+
+        return directories + files
+
+    def set_show_hidden_files(self, if_show):
+        if type(if_show) != bool:
+            raise TypeError(_('The parameter must to be a bool'))
+
+        self.show_hidden_files = if_show
+        GObject.idle_add(self.scan)
+
+
+class FileSearch(GObject.GObject):
+    """
+    Searchs files by name under a folder. The folders are listed in parallel
+    by a pool of threads, and the matches are emitted in batches while the
+    search continues.
+    """
+
+    __gsignals__ = {
+        'results-found': (GObject.SIGNAL_RUN_FIRST, None, [object]),
+        'finished': (GObject.SIGNAL_RUN_FIRST, None, []),
+        }
+
+    def __init__(self, folder, text, mode=SEARCH_SUBSTRING, max_depth=None,
+                 same_mount=True, show_hidden_files=False, workers=8):
+
+        GObject.GObject.__init__(self)
+
+        self.folder = folder
+        self.text = text
+        self.mode = mode
+        self.max_depth = max_depth
+        self.same_mount = same_mount
+        self.show_hidden_files = show_hidden_files
+        self.workers = workers
+        self.active = False
+        self.mounts = set()
+        self.match = get_name_matcher(text, mode)
+        self.queue = Queue.Queue()
+        self.results = []
+        self.last_flush = 0
+        self.lock = thread.allocate_lock()
+
+    def start(self):
+        self.active = True
+        self.last_flush = time.time()
+        if self.same_mount:
+            # The folders of other devices are the mount points under the
+            # folder, so they are skipped without a lstat for each folder.
+            real = os.path.realpath(self.folder).rstrip('/')
+            root = self.folder.rstrip('/')
+            self.mounts = set([root + x[len(real):]
+                               for x in get_mount_points()
+                               if x.startswith(real + '/')])
+
+        self.queue.put((self.folder, 0))
+        for x in range(self.workers):
+            thread.start_new_thread(self.__work, ())
+
+        thread.start_new_thread(self.__wait, ())
+
+    def cancel(self):
+        self.active = False
+
+    def __work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            # The folders found are kept in a local stack, and only shared
+            # with the other threads when they have nothing to do.
+            stack = [item]
+            while stack and self.active:
+                try:
+                    folders = self.__scan(*stack.pop())
+
+                except Exception:
+                    continue
+
+                for folder in folders:
+                    if self.queue.qsize() < self.workers:
+                        self.queue.put(folder)
+
+                    else:
+                        stack.append(folder)
+
+            self.queue.task_done()
+
+    def __scan(self, folder, depth):
+        found = []
+        folders = []
+        can_go_down = self.max_depth is None or depth < self.max_depth
+
+        for name, path, is_dir in list_directory(folder):
+            if (name.startswith('.') or name.endswith('~')) and \
+                    not self.show_hidden_files:
+                continue
+
+            if self.match(name):
+                found.append(path + '/' if is_dir else path)
+
+            if is_dir and can_go_down and path not in self.mounts:
+                folders.append((path, depth + 1))
+
+        if found:
+            self.__add_results(found)
+
+        return folders
+
+    def __add_results(self, paths):
+        with self.lock:
+            self.results.extend(paths)
+            if len(self.results) < 200 and time.time() - self.last_flush < 0.1:
+                return
+
+        self.__flush()
+
+    def __flush(self):
+        with self.lock:
+            results = self.results
+            self.results = []
+            self.last_flush = time.time()
+
+        if results and self.active:
+            GObject.idle_add(self.emit, 'results-found', results)
+
+    def __wait(self):
+        self.queue.join()
+        for x in range(self.workers):
+            self.queue.put(None)
+
+        self.__flush()
+        self.active = False
+        GObject.idle_add(self.emit, 'finished')
+
+
+def start_search_pool(processes=None):
+    # A pool of processes can not be forked safely from a threaded program,
+    # so it must be started before any thread.
+    global search_pool, search_cancelled
+    search_cancelled = multiprocessing.Array('b', CONTENT_SEARCH_SLOTS,
+                                             lock=False)
+
+    search_pool = multiprocessing.Pool(processes)
+
+
+class ContentSearch(GObject.GObject):
+    """
+    Searchs text inside the files under a folder. One thread lists the
+    files, and their contents are examinated by the pool of processes of
+    start_search_pool, so the search uses all the cores. Without that pool,
+    they are examinated by a pool of threads, that only overlaps the reads.
+    The matches are emitted as a list of (path, line number, line) while the
+    search continues.
+    """
+
+    __gsignals__ = {
+        'results-found': (GObject.SIGNAL_RUN_FIRST, None, [object]),
+        'finished': (GObject.SIGNAL_RUN_FIRST, None, []),
+        }
+
+    def __init__(self, folder, text, mode=SEARCH_SUBSTRING, same_mount=True,
+                 show_hidden_files=False, max_size=CONTENT_SEARCH_MAX_SIZE,
+                 threads=None):
+
+        GObject.GObject.__init__(self)
+
+        if mode == SEARCH_REGEX:
+            re.compile(text)  # Raises re.error with invalid expressions
+
+        self.folder = folder
+        self.text = text
+        self.mode = mode
+        self.same_mount = same_mount
+        self.show_hidden_files = show_hidden_files
+        self.max_size = max_size
+        self.threads = threads or multiprocessing.cpu_count() * 2
+        self.active = False
+        self.found = 0
+        self.slot = None
+
+    def start(self):
+        global search_count
+        self.active = True
+        if search_pool is not None:
+            self.slot = search_count % CONTENT_SEARCH_SLOTS
+            search_count += 1
+            search_cancelled[self.slot] = 0
+
+        thread.start_new_thread(self.__search, ())
+
+    def cancel(self):
+        self.active = False
+        if self.slot is not None:
+            # The files already sent to the processes are skipped
+            search_cancelled[self.slot] = 1
+
+    def __get_chunks(self):
+        chunk = []
+        for path in walk_files(self.folder, self.show_hidden_files,
+                               self.same_mount):
+
+            if not self.active:
+                break
+
+            chunk.append(path)
+            if len(chunk) == 32:
+                yield (chunk, self.text, self.mode, self.max_size, self.slot)
+                chunk = []
+
+        if chunk:
+            yield (chunk, self.text, self.mode, self.max_size, self.slot)
+
+    def __search(self):
+        if search_pool is not None:
+            results = search_pool.imap_unordered(grep_files,
+                                                 self.__get_chunks())
+
+            for matches in results:
+                self.__add_matches(matches)
+                if not self.active:
+                    break
+
+        else:
+            self.__search_in_threads()
+
+        self.active = False
+        GObject.idle_add(self.emit, 'finished')
+
+    def __add_matches(self, matches):
+        if matches and self.active:
+            self.found += len(matches)
+            GObject.idle_add(self.emit, 'results-found', matches)
+
+        if self.found >= CONTENT_SEARCH_LIMIT:
+            # The workers end when the listing ends
+            self.cancel()
+
+    def __search_in_threads(self):
+        chunks = Queue.Queue(self.threads * 2)
+        results = Queue.Queue()
+
+        def work():
+            while True:
+                args = chunks.get()
+                if args is None:
+                    results.put(None)
+                    return
+
+                if self.active:
+                    results.put(grep_files(args))
+
+        def list_files():
+            for args in self.__get_chunks():
+                chunks.put(args)
+
+            for x in range(self.threads):
+                chunks.put(None)
+
+        for x in range(self.threads):
+            thread.start_new_thread(work, ())
+
+        thread.start_new_thread(list_files, ())
+
+        running = self.threads
+        while running:
+            matches = results.get()
+            if matches is None:
+                running -= 1
+                continue
+
+            self.__add_matches(matches)
+
+
+class FileIndex(GObject.GObject):
+    """
+    A locate-like index with all the paths under a folder. It is saved on
+    INDEX_FILE with the sorted paths front-coded (only the part that differs
+    from the previous path is written) and compressed.
+
+    The index is updated in a thread, the folders whose modification time
+    is the same that in the last update are not listed again.
+
+    In memory, the paths and the names are kept in strings separated by new
+    lines, so a search is done with str.find over the names.
+    """
+
+    __gsignals__ = {
+        'updated': (GObject.SIGNAL_RUN_FIRST, None, []),
+        }
+
+    def __init__(self, folder=HOME_DIR, path=INDEX_FILE,
+                 max_entries=INDEX_MAX_ENTRIES):
+
+        GObject.GObject.__init__(self)
+
+        self.folder = folder.rstrip('/') or '/'
+        self.path = path
+        self.max_entries = max_entries
+        self.blob = ''  # The paths, one for each line
+        self.names = ''  # The names in lower case, one for each line
+        self.offsets = array.array('l')  # Where each line starts
+        self.name_offsets = array.array('l', [0])
+        self.folders = {}  # {folder: modification time}
+        self.truncated = False
+        self.loaded = False
+        self.updating = False
+        self.size = 0  # Size of the index file
+        self.timeout = None
+        self.lock = thread.allocate_lock()
+
+    def start(self, interval=INDEX_UPDATE_INTERVAL):
+        self.update(load=True)
+        self.timeout = GObject.timeout_add(interval, self.update)
+
+    def stop(self):
+        if self.timeout:
+            GObject.source_remove(self.timeout)
+            self.timeout = None
+
+    def update(self, load=False):
+        if not self.updating:
+            self.updating = True
+            thread.start_new_thread(self.__update, (load,))
+
+        return True
+
+    def query(self, text, mode=SEARCH_SUBSTRING, folder=None,
+              show_hidden_files=False, limit=5000):
+
+        # Returns None when the index can not answer, so the caller has to
+        # search in the filesystem.
+        root = self.folder.rstrip('/')
+        folder = (folder or self.folder).rstrip('/')
+        inside = folder == root or folder.startswith(root + '/')
+
+        if not self.loaded or self.truncated or not inside or \
+                mode == SEARCH_REGEX:
+            return None
+
+        text = text.lower()
+        match = None
+        needle = text
+        if mode == SEARCH_GLOB:
+            # The longest part without wildcards is searched first, the
+            # classes ([abc], [!abc]) match one character of several.
+            match = re.compile(fnmatch.translate(text)).match
+            literals = re.sub(r'\[!?\]?[^\]]*\]', '*', text)
+            needle = max(re.split('[*?\\[\\]]', literals), key=len)
+
+        prefix = folder + '/'
+        results = []
+
+        with self.lock:
+            blob = self.blob
+            names = self.names
+            offsets = self.offsets
+            name_offsets = self.name_offsets
+            first = self.__find_line(prefix)
+            last = self.__find_line(prefix[:-1] + chr(ord('/') + 1))
+
+        if first == last:
+            return results
+
+        position = name_offsets[first]
+        end = name_offsets[last]
+        while position < end:
+            # Only the names are searched, so the parent folders that
+            # contains the text do not add false matches.
+            found = names.find(needle, position, end)
+            if found < 0:
+                break
+
+            idx = bisect.bisect_right(name_offsets, found) - 1
+            position = names.find('\n', found) + 1
+            if match and not match(names[name_offsets[idx]:position - 1]):
+                continue
+
+            path = blob[offsets[idx]:blob.find('\n', offsets[idx])]
+            if not show_hidden_files and '/.' in path[len(folder):]:
+                continue
+
+            results.append(path + '/' if path in self.folders else path)
+            if len(results) >= limit:
+                break
+
+        return results
+
+    def __find_line(self, text):
+        # Binary search of the first line that is not lower than text
+        low = 0
+        high = len(self.offsets)
+        while low < high:
+            middle = (low + high) / 2
+            start = self.offsets[middle]
+            if self.blob[start:self.blob.find('\n', start)] < text:
+                low = middle + 1
+
+            else:
+                high = middle
+
+        return low
+
+    def __update(self, load):
+        try:
+            if load:
+                self.__load()
+
+            self.__scan()
+
+        finally:
+            self.updating = False
+
+        GObject.idle_add(self.emit, 'updated')
+
+    def __scan(self):
+        children = {}  # {folder: [(name, is_dir)]} of the last update
+        with self.lock:
+            blob = self.blob
+            old_folders = self.folders
+
+        for path in blob.splitlines():
+            parent, name = path.rsplit('/', 1)
+            children.setdefault(parent or '/', []).append(
+                (name, path in old_folders))
+
+        try:
+            device = os.lstat(self.folder).st_dev
+
+        except OSError:
+            return
+
+        paths = []
+        folders = {}
+        truncated = False
+        stack = [self.folder]
+
+        while stack:
+            folder = stack.pop()
+            try:
+                info = os.lstat(folder)
+
+            except OSError:
+                continue
+
+            folders[folder] = info.st_mtime
+            if info.st_dev != device:
+                continue  # Other mount point
+
+            if old_folders.get(folder, None) == info.st_mtime and \
+                    folder in children:
+                items = children[folder]
+
+            else:
+                items = [(name, is_dir) for name, path, is_dir in
+                         list_directory(folder)]
+
+            for name, is_dir in items:
+                path = os.path.join(folder, name)
+                paths.append(path)
+                if is_dir:
+                    stack.append(path)
+
+            if len(paths) >= self.max_entries:
+                truncated = True
+                break
+
+        paths.sort()
+        self.__set_paths(paths, folders, truncated)
+        self.__save(paths, folders, truncated)
+
+    def __set_paths(self, paths, folders, truncated):
+        offsets = array.array('l')
+        name_offsets = array.array('l')
+        names = []
+        position = 0
+        name_position = 0
+        for path in paths:
+            name = path[path.rfind('/') + 1:].lower()
+            names.append(name)
+            offsets.append(position)
+            name_offsets.append(name_position)
+            position += len(path) + 1
+            name_position += len(name) + 1
+
+        name_offsets.append(name_position)
+
+        with self.lock:
+            self.blob = '\n'.join(paths) + '\n' if paths else ''
+            self.names = '\n'.join(names) + '\n' if names else ''
+            self.offsets = offsets
+            self.name_offsets = name_offsets
+            self.folders = folders
+            self.truncated = truncated
+            self.loaded = True
+
+    def __load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        try:
+            data = open(self.path, 'rb').read()
+            header, data = data.split('\n', 1)
+            version, folder, truncated = header.split('\t')
+            lines = zlib.decompress(data).splitlines()
+
+        except (IOError, ValueError, zlib.error):
+            return
+
+        if version != 'CEXPLORER-INDEX 1' or folder != self.folder:
+            return
+
+        paths = []
+        folders = {}
+        previous = ''
+        for line in lines:
+            shared, suffix, mtime = line.split('\t')
+            path = previous[:int(shared)] + suffix
+            previous = path
+
+            if mtime:
+                folders[path] = float(mtime)
+
+            if path != self.folder:
+                paths.append(path)
+
+        self.size = os.path.getsize(self.path)
+        self.__set_paths(paths, folders, truncated == '1')
+
+    def __save(self, paths, folders, truncated):
+        lines = []
+        previous = ''
+        for path in [self.folder] + paths:
+            shared = 0
+            limit = min(len(previous), len(path))
+            while shared < limit and previous[shared] == path[shared]:
+                shared += 1
+
+            mtime = repr(folders[path]) if path in folders else ''
+            lines.append('%d\t%s\t%s' % (shared, path[shared:], mtime))
+            previous = path
+
+        header = 'CEXPLORER-INDEX 1\t%s\t%d\n' % (self.folder, truncated)
+        data = zlib.compress('\n'.join(lines), 6)
+
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+
+            temp = self.path + '.tmp'
+            _file = open(temp, 'wb')
+            _file.write(header + data)
+            _file.close()
+            os.rename(temp, self.path)
+            self.size = len(header) + len(data)
+
+        except (IOError, OSError):
+            pass
+
+
+class SelectionStats(GObject.GObject):
+    """
+    Computes the size of the selected items in a thread. Only the items that
+    are added to the selection are examinated, and the results are cached
+    until refresh() is called.
+    """
+
+    __gsignals__ = {
+        'changed': (GObject.SIGNAL_RUN_FIRST, None, [str]),
+        }
+
+    def __init__(self, delay=150):
+        GObject.GObject.__init__(self)
+
+        self.delay = delay
+        self.cache = {}  # {path: (is_folder, items or bytes)}
+        self.selected = set()
+        self.pending = set()
+        self.counted = set()
+        self.folders = set()
+        self.files = set()
+        self.quantity = 0
+        self.size = 0
+        self.generation = 0
+        self.timeout = None
+        self.lock = thread.allocate_lock()
+
+    def set_selection(self, paths):
+        paths = set(paths)
+
+        with self.lock:
+            for path in self.selected - paths:
+                self.pending.discard(path)
+                if path in self.counted:
+                    self.__count(path, -1)
+
+            self.pending.update(paths - self.selected)
+            self.selected = paths
+            self.generation += 1
+
+        if self.timeout:
+            GObject.source_remove(self.timeout)
+
+        self.timeout = GObject.timeout_add(self.delay, self.__start)
+
+    def refresh(self):
+        with self.lock:
+            self.cache = {}
+            self.counted = set()
+            self.folders = set()
+            self.files = set()
+            self.quantity = 0
+            self.size = 0
+
+        selected = self.selected
+        self.selected = set()
+        self.set_selection(selected)
+
+    def get_label(self):
+        with self.lock:
+            return format_size(list(self.folders), list(self.files),
+                               self.quantity, self.size)
+
+    def __count(self, path, sign):
+        is_folder, value = self.cache[path]
+        if sign > 0:
+            self.counted.add(path)
+            (self.folders if is_folder else self.files).add(path)
+
+        else:
+            self.counted.remove(path)
+            (self.folders if is_folder else self.files).remove(path)
+
+        if is_folder:
+            self.quantity += value * sign
+
+        else:
+            self.size += value * sign
+
+    def __start(self):
+        self.timeout = None
+        thread.start_new_thread(self.__compute, (self.generation,))
+        return False
+
+    def __compute(self, generation):
+        while True:
+            with self.lock:
+                if generation != self.generation or not self.pending:
+                    break
+
+                path = self.pending.pop()
+                data = self.cache.get(path, None)
+
+            if data is None:
+                data = get_path_size(path)
+
+            with self.lock:
+                if data is None:
+                    continue
+
+                self.cache[path] = data
+                if path in self.selected and not path in self.counted:
+                    self.__count(path, 1)
+
+        if generation == self.generation:
+            GObject.idle_add(self.emit, 'changed', self.get_label())
+
+
+class TokenBucket(object):
+    """
+    Limits the bytes per second of the threads that call consume. The
+    bucket gets rate tokens per second, up to rate (one second of burst),
+    and a thread that takes more tokens than there are waits until the
+    bucket is not in debt. A rate of 0 means no limit.
+    """
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = rate
+        self.time = time.time()
+        self.lock = thread.allocate_lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.__refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, rate)
+
+    def consume(self, size, active=lambda: True):
+        with self.lock:
+            self.__refill()
+            if not self.rate:
+                return
+
+            self.tokens -= size
+
+        # The rate can change (or the operation be canceled) while waiting
+        while active():
+            with self.lock:
+                self.__refill()
+                if not self.rate or self.tokens >= 0:
+                    return
+
+                wait = -self.tokens / float(self.rate)
+
+            time.sleep(min(wait, 0.1))
+
+    def __refill(self):
+        now = time.time()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+
+class CCPManager(GObject.GObject):
+    # Cut, Copy and Paste
+
+    __gsignals__ = {
+        'error': (GObject.SIGNAL_RUN_FIRST, None, [int]),
+        'warning': (GObject.SIGNAL_RUN_FIRST, None, [str]),
+        'added': (GObject.SIGNAL_RUN_FIRST, None, [float]),
+        'start': (GObject.SIGNAL_RUN_FIRST, None, [float]),
+        'progress-changed': (GObject.SIGNAL_RUN_FIRST, None, [float]),
+        'end': (GObject.SIGNAL_RUN_FIRST, None, [float]),
+        'queue-changed': (GObject.SIGNAL_RUN_FIRST, None, []),
+        }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+
+        # The operations wait in the queue until no running operation uses
+        # their devices, so the operations on a device run one after
+        # another and the operations on different devices in parallel.
+        self.queue = []
+        self.running = []
+        self.operations = {}
+        # Operations structur:
+        #    {time_id: {'action': int,
+        #               'files': list,
+        #               'destination': str,
+        #               'active': bool,
+        #               'paused': bool,
+        #               'devices': set,  # st_dev of sources and destination
+        #               'parallel': bool,
+        #               'pools': dict,  # {(st_dev, function): (Queue, int)}
+        #               'durability': int,
+        #               'clone': bool,  # Try reflinks
+        #               'clone-failed': set,  # {(source dev, target dev)}
+        #               'hardlinks': bool,
+        #               'verify': bool,
+        #               'bucket': TokenBucket,  # Rate limit
+        #               'idle': bool,  # Idle I/O priority
+        #               'verify-queue': Queue,  # (source, target, digest)
+        #               'inodes': dict,  # {(st_dev, st_ino): target}
+        #               'strategies': set,  # How the data was copied
+        #               'total-size': int,
+        #               'total-files': int,
+        #               'progress': int,  # Bytes copied
+        #               'done-files': int,
+        #               'current-file': str,
+        #               'speed': float,  # Bytes per second
+        #               'eta': float,  # Seconds
+        #               'errors': list,  # [(path, message), ...]
+        #               'conflicts': list,  # [(path, existing target), ...]
+        #               'journal': file,
+        #               'resume': dict}}  # Read from a journal
+
+        # Each operation writes a journal in JOURNAL_DIR, with a line for
+        # each event, so it can be resumed if the program is closed:
+        #    {"action": str, "files": list, "destination": str, ...}
+        #    {"item": source, "target": path}  # Name chosen for an item
+        #    {"item": source, "temporary": path}  # For moves across devices
+        #    {"moved": source}  # The copy was renamed to its target
+        #    {"done": source}  # A file or link was copied
+        #    {"offset": [source, bytes]}  # A file is being copied
+
+        # The files of the operations that write in the same device are
+        # copied by at most workers[st_dev] threads at the same time.
+        self.workers = {}
+        self.slots = {}
+        self.lock = thread.allocate_lock()
+        self.bucket = TokenBucket(COPY_RATE_LIMIT)
+
+    def set_rate_limit(self, rate, time_id=None):
+        # Bytes per second of an operation, or of all if time_id is None
+        if time_id is None:
+            self.bucket.set_rate(rate)
+
+        else:
+            self.operations[time_id]['bucket'].set_rate(rate)
+
+    def get_rate_limit(self, time_id=None):
+        if time_id is None:
+            return self.bucket.rate
+
+        return self.operations[time_id]['bucket'].rate
+
+    def set_idle_priority(self, time_id, idle):
+        # The threads of the operation change their priority before the
+        # next chunk
+        self.operations[time_id]['idle'] = idle
+
+    def set_device_workers(self, path, workers):
+        device = os.stat(path).st_dev
+        with self.lock:
+            self.workers[device] = workers
+            self.slots.pop(device, None)
+
+    def __get_device_slots(self, device):
+        # Returns a queue with a token for each thread that can copy files
+        # in the device.
+        with self.lock:
+            if device not in self.slots:
+                workers = self.workers.get(device, COPY_WORKERS_PER_DEVICE)
+                self.slots[device] = Queue.Queue()
+                for x in range(workers):
+                    self.slots[device].put(x)
+
+            return self.slots[device]
+
+    def __schedule(self):
+        busy = set()
+        for time_id in self.running:
+            # A paused operation keeps its devices
+            busy.update(self.operations[time_id]['devices'])
+
+        for time_id in self.queue[:]:
+            operation = self.operations[time_id]
+            if operation['paused']:
+                continue
+
+            if operation['devices'] & busy:
+                # The next operations on these devices wait for this one
+                busy.update(operation['devices'])
+                continue
+
+            busy.update(operation['devices'])
+            self.queue.remove(time_id)
+            self.running.append(time_id)
+            self.__start_new_operation(time_id)
+
+        self.emit('queue-changed')
+        return False
+
+    def __operation_ended(self, time_id):
+        if time_id in self.running:
+            self.running.remove(time_id)
+
+        elif time_id in self.queue:
+            self.queue.remove(time_id)
+
+        self.operations[time_id]['active'] = False
+        self.emit('end', time_id)
+        self.__schedule()
+        return False
+
+    def __wait(self, operation):
+        while operation['paused'] and operation['active']:
+            time.sleep(0.1)
+
+    def __get_chunk_size(self, operation):
+        # With a rate limit the chunks are small, so the copy goes at a
+        # steady speed instead of a burst followed by a long wait.
+        rates = [x for x in [operation['bucket'].rate, self.bucket.rate] if x]
+        if not rates:
+            return COPY_CHUNK_SIZE
+
+        size = int(min(rates) * COPY_RATE_CHUNK_TIME)
+        return max(COPY_MIN_CHUNK_SIZE, min(size, COPY_CHUNK_SIZE))
+
+    def __throttle(self, operation, size):
+        active = lambda: operation['active']
+        operation['bucket'].consume(size, active)
+        self.bucket.consume(size, active)
+
+    def __start_new_operation(self, time_id):
+        operation = self.operations[time_id]
+
+        def start():
+            GObject.idle_add(self.emit, 'start', time_id)
+            finished = False
+            try:
+                self.__run_operation(operation)
+                finished = True
+
+            except Exception as error:
+                # An unexpected error, like a destination unplugged while it
+                # is planned, must not leave the operation running forever.
+                operation['active'] = False
+                path = operation['current-file'] or operation['destination']
+                self.__add_error(operation, path,
+                                 getattr(error, 'errno', None) or errno.EIO)
+
+            finally:
+                self.__stop_workers(operation)
+                if operation['verify-queue'] is not None and not finished:
+                    operation['verify-queue'].put(None)
+
+                # The journal of an operation that failed is kept, so it
+                # can be resumed.
+                operation['current-file'] = None
+                self.__close_journal(operation, remove=finished)
+                GObject.idle_add(self.emit, 'progress-changed', time_id)
+                GObject.idle_add(self.__operation_ended, time_id)
+
+        readable, writable = get_access(operation['destination'])
+        if not writable:
+            #self.emit('error', 0)
+            self.__add_error(operation, operation['destination'],
+                             errno.EACCES)
+            self.__close_journal(operation)
+            GObject.idle_add(self.__operation_ended, time_id)
+            return
+
+        thread.start_new_thread(start, ())
+
+    def __run_operation(self, operation):
+        # Runs in the thread of the operation
+        action = operation['action']
+        destination = operation['destination']
+        operation['last-update'] = time.time()
+        jobs = self.__plan(operation)
+
+        if operation['verify']:
+            self.__start_verifier(operation)
+
+        for kind, path, target, entries, errors in jobs:
+            self.__wait(operation)
+            if not operation['active']:
+                break
+
+            set_io_priority(operation['idle'])
+
+            if kind == 'done':
+                # Moved before the program was closed
+                self.__add_progress(operation, 0, 1)
+
+            elif kind == 'rename':
+                self.__rename_path(operation, path, target)
+
+            elif kind == 'move':
+                self.__move_path(operation, path, target, entries, errors)
+
+            elif kind == 'copy':
+                self.__copy_path(operation, entries, target)
+
+            elif kind == 'remove':
+                self.__remove_tree(operation, path, entries)
+
+        if operation['verify']:
+            operation['verify-queue'].put(None)
+            operation['verify-queue'].join()
+
+        if operation['durability'] == DURABILITY_SYNCFS and \
+                action == COPY and operation['active']:
+            # One flush for all the files
+            try:
+                syncfs(destination)
+
+            except OSError as error:
+                self.__add_error(operation, destination, error.errno)
+
+    def __plan(self, operation):
+        # Walks the sources once, and returns what must be done with each
+        # one: (kind, path, target, entries, planning errors). The entries
+        # are used by __copy_path, and the totals, the names in use and
+        # the free space are known before writing anything.
+        action = operation['action']
+        destination = operation['destination']
+        resume = operation['resume']
+        jobs = []
+        inodes = set()
+        devices = set()
+        needed = 0
+
+        for path in operation['files']:
+            if not operation['active']:
+                break
+
+            path = path.rstrip('/') or '/'
+            if action == REMOVE:
+                entries, errors, size = self.__plan_tree(operation, path,
+                                                         inodes)
+
+                jobs.append(('remove', path, None, entries, errors))
+                continue
+
+            target = resume['targets'].get(path)
+            if target and not os.path.lexists(path) and \
+                    os.path.lexists(target):
+                operation['total-files'] += 1
+                jobs.append(('done', path, target, None, 0))
+                continue
+
+            if not target:
+                target = os.path.join(destination, get_name(path))
+                if os.path.lexists(target):
+                    # The file is not replaced, it is copied with other name
+                    operation['conflicts'].append((path, target))
+                    target = get_copy_name(target)
+
+                self.__write_journal(operation, item=path, target=target)
+
+            if os.path.isdir(path) and \
+                    (destination + '/').startswith(path + '/'):
+                # A folder can not be copied inside itself
+                self.__add_error(operation, path, errno.EINVAL)
+                continue
+
+            if action == CUT and same_device(path, destination):
+                # The moves inside a device do not copy any byte
+                operation['total-files'] += 1
+                jobs.append(('rename', path, target, None, 0))
+                continue
+
+            entries, errors, size = self.__plan_tree(operation, path, inodes)
+            needed += size
+            devices.update([x[2].st_dev for x in entries])
+            kind = 'move' if action == CUT else 'copy'
+            jobs.append((kind, path, target, entries, errors))
+
+        free = get_free_space(destination)
+        cloned = operation['clone'] and \
+            devices <= set([os.stat(destination).st_dev])
+
+        if needed > free and not resume['targets'] and not cloned:
+            # Reflinks inside the device could need no space
+            self.__add_error(operation, destination, errno.ENOSPC)
+            return []
+
+        return jobs
+
+    def __plan_tree(self, operation, path, inodes):
+        # Returns the entries (source, path relative to the target, info)
+        # of the tree of path, the errors found and the size to copy.
+        entries = []
+        errors = 0
+        size = 0
+
+        for source, relative, info, number in walk_tree(path):
+            if number is not None:
+                self.__add_error(operation, source, number)
+                errors += 1
+                continue
+
+            entries.append((source, relative, info))
+            if stat.S_ISDIR(info.st_mode):
+                continue
+
+            operation['total-files'] += 1
+            if stat.S_ISREG(info.st_mode) and info.st_nlink > 1:
+                # The hard links are copied once
+                if (info.st_dev, info.st_ino) in inodes:
+                    continue
+
+                inodes.add((info.st_dev, info.st_ino))
+
+            if stat.S_ISREG(info.st_mode):
+                allocated = get_allocated_size(info)
+                operation['total-size'] += allocated
+                size += allocated
+
+            # Shows the totals while they are counted
+            self.__add_progress(operation, 0)
+
+        return entries, errors, size
+
+    def __rename_path(self, operation, path, target):
+        # Inside a device a rename is enough, whatever the size of the tree
+        try:
+            os.rename(path, target)
+            operation['strategies'].add('rename')
+            self.__add_progress(operation, 0, 1)
+            return
+
+        except OSError as error:
+            if error.errno != errno.EXDEV:  # A bind mount
+                self.__add_error(operation, path, error.errno)
+                return
+
+        # This item was counted as one file
+        operation['total-files'] -= 1
+        entries, errors, size = self.__plan_tree(operation, path, set())
+        self.__move_path(operation, path, target, entries, errors)
+
+    def __move_path(self, operation, path, target, entries, errors):
+        # The tree is copied to a temporary name next to target, synced and
+        # renamed, so an interrupted move never leaves an incomplete
+        # target, and then path is removed (if nothing failed).
+        folder = os.path.dirname(target)
+        resume = operation['resume']
+        temporary = resume['temporaries'].get(path)
+
+        if path not in resume['moved']:
+            if not temporary:
+                temporary = get_copy_name(
+                    os.path.join(folder, '.%s.part' % get_name(path)))
+
+                self.__write_journal(operation, item=path,
+                                     temporary=temporary)
+
+            count = len(operation['errors'])
+            self.__copy_path(operation, entries, temporary)
+
+            if errors or not operation['active'] or \
+                    len(operation['errors']) != count:
+                remove_path(temporary, ignore_errors=True)
+                self.__move_inodes(operation, temporary, None)
+                return
+
+        try:
+            if path not in resume['moved']:
+                if operation['durability'] != DURABILITY_FDATASYNC:
+                    # The original is removed, so the copy must be in the
+                    # device whatever the durability.
+                    syncfs(temporary)
+
+                os.rename(temporary, target)
+                self.__move_inodes(operation, temporary, target)
+                sync_path(folder)
+                self.__write_journal(operation, moved=path)
+
+            remove_path(path)
+
+        except OSError as error:
+            self.__add_error(operation, path, error.errno)
+
+    def __move_inodes(self, operation, old, new):
+        # The first copies of the hard links under old are now under new,
+        # or were removed if new is None.
+        for inode, path in operation['inodes'].items():
+            if path == old or path.startswith(old + '/'):
+                if new is None:
+                    del operation['inodes'][inode]
+
+                else:
+                    operation['inodes'][inode] = new + path[len(old):]
+
+    def __copy_path(self, operation, entries, target):
+        # The entries come from the planning walk, the folders first. The
+        # permissions of the folders are set at the end, so read only
+        # folders can be filled. In parallel mode this thread only creates
+        # the folders and the links, and the files are copied by a pool of
+        # threads. The hard links to files already copied are created at
+        # the end, when their first copies are complete.
+        folders = []
+        hardlinks = []
+        files = None
+        resume = bool(operation['resume']['targets'])
+        root = target
+
+        if operation['parallel']:
+            files = self.__get_workers(operation, root)
+
+        for source, relative, info in entries:
+            self.__wait(operation)
+            if not operation['active']:
+                break
+
+            target = os.path.join(root, relative) if relative else root
+            inode = (info.st_dev, info.st_ino)
+
+            try:
+                if stat.S_ISDIR(info.st_mode):
+                    if not (resume and os.path.isdir(target)):
+                        os.mkdir(target, 0700)
+
+                    folders.append((target, info))
+
+                elif stat.S_ISLNK(info.st_mode):
+                    if not (resume and os.path.islink(target)):
+                        os.symlink(os.readlink(source), target)
+
+                    self.__add_progress(operation, 0, 1)
+
+                elif stat.S_ISREG(info.st_mode) and info.st_nlink > 1 and \
+                        operation['hardlinks'] and \
+                        inode in operation['inodes']:
+
+                    hardlinks.append((operation['inodes'][inode], target))
+
+                elif stat.S_ISREG(info.st_mode) and files is not None:
+                    files.put((source, target, info))
+
+                elif stat.S_ISREG(info.st_mode):
+                    self.__copy_file(operation, source, target, info)
+
+                if stat.S_ISREG(info.st_mode) and info.st_nlink > 1:
+                    operation['inodes'].setdefault(inode, target)
+
+            except (OSError, IOError) as error:
+                self.__add_error(operation, source, error.errno)
+
+        if files is not None:
+            files.join()
+
+        for source, target in hardlinks:
+            try:
+                if not (resume and os.path.lexists(target)):
+                    os.link(source, target)
+
+                operation['strategies'].add('hardlink')
+                self.__add_progress(operation, 0, 1)
+
+            except OSError as error:
+                self.__add_error(operation, target, error.errno)
+
+        for target, info in reversed(folders):
+            try:
+                os.chmod(target, stat.S_IMODE(info.st_mode))
+                os.utime(target, (info.st_atime, info.st_mtime))
+                if operation['durability'] == DURABILITY_FDATASYNC:
+                    sync_path(target)
+
+            except OSError as error:
+                self.__add_error(operation, target, error.errno)
+
+    def __start_verifier(self, operation):
+        # The copies are checked in this thread while the next files are
+        # copied.
+        operation['verify-queue'] = Queue.Queue(COPY_QUEUE_SIZE)
+
+        def verify():
+            while True:
+                item = operation['verify-queue'].get()
+                if item is None:
+                    operation['verify-queue'].task_done()
+                    return
+
+                source, target, digest = item
+                try:
+                    set_io_priority(operation['idle'])
+                    if operation['active'] and \
+                            get_file_digest(target) != digest:
+                        operation['errors'].append((target,
+                                                    MSG_VERIFY_FAILED))
+
+                except (OSError, IOError) as error:
+                    self.__add_error(operation, target, error.errno)
+
+                operation['verify-queue'].task_done()
+
+        thread.start_new_thread(verify, ())
+
+    def __remove_tree(self, operation, path, entries):
+        # The files are removed by a pool of threads (in parallel mode),
+        # and then the folders, the deepest first. Nothing is followed,
+        # the entries come from the planning walk.
+        folders = []
+        files = None
+
+        if operation['parallel']:
+            files = self.__get_workers(operation, path, self.__remove_file)
+
+        for source, relative, info in entries:
+            self.__wait(operation)
+            if not operation['active']:
+                break
+
+            try:
+                if stat.S_ISDIR(info.st_mode):
+                    if not info.st_mode & stat.S_IWUSR:
+                        # The content of a read only folder can't be removed
+                        os.chmod(source, stat.S_IMODE(info.st_mode) | 0700)
+
+                    folders.append(source)
+
+                elif files is not None:
+                    files.put((source, info))
+
+                else:
+                    self.__remove_file(operation, source, info)
+
+            except OSError as error:
+                self.__add_error(operation, source, error.errno)
+
+        if files is not None:
+            files.join()
+
+        for folder in reversed(folders):
+            if not operation['active']:
+                break
+
+            try:
+                os.rmdir(folder)
+
+            except OSError as error:
+                self.__add_error(operation, folder, error.errno)
+
+    def __remove_file(self, operation, source, info):
+        operation['current-file'] = source
+        os.unlink(source)
+
+        size = 0
+        if stat.S_ISREG(info.st_mode):
+            size = get_allocated_size(info)
+            if info.st_nlink > 1:
+                with operation['lock']:
+                    # The hard links were counted once
+                    inode = (info.st_dev, info.st_ino)
+                    if operation['inodes'].setdefault(inode, source) != \
+                            source:
+                        size = 0
+
+        self.__add_progress(operation, size, 1)
+
+    def __get_workers(self, operation, target, function=None):
+        # Returns the queue of (source, ...) tuples for function (by
+        # default __copy_file) in the device of target. The threads are
+        # started once per operation and stopped by __stop_workers.
+        function = function or self.__copy_file
+        device = os.stat(os.path.dirname(target)).st_dev
+        key = (device, function)
+        if key not in operation['pools']:
+            operation['pools'][key] = self.__start_workers(operation, device,
+                                                           function)
+
+        return operation['pools'][key][0]
+
+    def __stop_workers(self, operation):
+        for files, workers in operation['pools'].values():
+            for x in range(workers):
+                files.put(None)
+
+        operation['pools'] = {}
+
+    def __start_workers(self, operation, device, function):
+        # Returns a queue of (source, ...) tuples for function and the
+        # number of threads reading it.
+        slots = self.__get_device_slots(device)
+        workers = max(1, self.workers.get(device, COPY_WORKERS_PER_DEVICE))
+        files = Queue.Queue(COPY_QUEUE_SIZE)
+
+        def work():
+            while True:
+                item = files.get()
+                if item is None:
+                    files.task_done()
+                    return
+
+                self.__wait(operation)
+                if operation['active']:
+                    slot = slots.get()
+                    try:
+                        # Each item, the priority can be changed while the
+                        # operation runs.
+                        set_io_priority(operation['idle'])
+                        function(operation, *item)
+
+                    except (OSError, IOError) as error:
+                        self.__add_error(operation, item[0], error.errno)
+
+                    finally:
+                        slots.put(slot)
+
+                files.task_done()
+
+        for x in range(workers):
+            thread.start_new_thread(work, ())
+
+        return files, workers
+
+    def __copy_file(self, operation, source, target, info):
+        operation['current-file'] = source
+        mode = stat.S_IMODE(info.st_mode)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        offset = 0
+
+        resume = operation['resume']
+        if resume['targets'] and os.path.isfile(target):
+            copied = os.lstat(target)
+            flags = os.O_WRONLY
+            if source in resume['done'] and \
+                    copied.st_size == info.st_size and \
+                    int(copied.st_mtime) == int(info.st_mtime):
+
+                self.__add_progress(operation, get_allocated_size(info), 1)
+                return
+
+            # Only the remainder of the file is copied, if the source did
+            # not change since the offset was written.
+            saved = resume['offsets'].get(source)
+            if saved and len(saved) == 3 and \
+                    saved[1:] == [info.st_size, info.st_mtime]:
+
+                offset = min(saved[0], copied.st_size, info.st_size)
+
+        fsource = os.open(source, os.O_RDONLY)
+
+        try:
+            ftarget = os.open(target, flags, mode)
+
+        except OSError:
+            os.close(fsource)
+            raise
+
+        # The progress counts the allocated bytes, so the holes of sparse
+        # files are not counted.
+        allocated = get_allocated_size(info)
+        strategies = operation['strategies']
+
+        try:
+            os.ftruncate(ftarget, offset)
+            os.lseek(fsource, offset, os.SEEK_SET)
+            os.lseek(ftarget, offset, os.SEEK_SET)
+            counted = min(offset, allocated)
+            self.__add_progress(operation, counted)
+
+            digest = None
+            if operation['verify']:
+                # The data goes through the buffer to be hashed, and the
+                # part copied before a resume is read again.
+                digest = hashlib.new(COPY_VERIFY_HASH)
+                if offset:
+                    os.lseek(fsource, 0, os.SEEK_SET)
+                    update_digest(digest, fsource, offset)
+
+            chunk = lambda: self.__get_chunk_size(operation)
+            if is_sparse(info):
+                data = copy_sparse_file_data(fsource, ftarget, info.st_size,
+                                             strategies, digest, chunk)
+
+            else:
+                data = copy_file_data(fsource, ftarget, strategies,
+                                      digest=digest, chunk=chunk)
+
+            # A clone would not read the data to hash it
+            devices = (info.st_dev, os.fstat(ftarget).st_dev)
+            clone = operation['clone'] and digest is None and \
+                devices not in operation['clone-failed']
+
+            if clone and clone_file(fsource, ftarget, offset):
+                strategies.add('reflink')
+                data = []
+
+            elif clone and not offset:
+                # The file systems do not support reflinks between them
+                operation['clone-failed'].add(devices)
+
+            last_write = time.time()
+            idle = operation['idle']
+            set_io_priority(idle)
+
+            for size in data:
+                counted += size
+                self.__add_progress(operation, size)
+                self.__throttle(operation, size)
+                if operation['idle'] != idle:
+                    idle = operation['idle']
+                    set_io_priority(idle)
+
+                if time.time() - last_write >= COPY_JOURNAL_INTERVAL:
+                    # The data before the offset must be in the device
+                    # before the offset is in the journal.
+                    last_write = time.time()
+                    offset = os.lseek(fsource, 0, os.SEEK_CUR)
+                    os.fdatasync(ftarget)
+                    self.__write_journal(
+                        operation, offset=[source, offset, info.st_size,
+                                           info.st_mtime])
+
+                self.__wait(operation)
+                if not operation['active']:
+                    break
+
+            if operation['active']:
+                # Creates the hole at the end of a sparse file
+                os.ftruncate(ftarget, info.st_size)
+                # The extents are rounded to blocks
+                self.__add_progress(operation, max(0, allocated - counted))
+
+            # With verify the data must be in the device to be read from
+            # there
+            sync = digest is not None or \
+                operation['durability'] == DURABILITY_FDATASYNC
+
+            if sync and operation['active']:
+                os.fdatasync(ftarget)
+
+        finally:
+            os.close(fsource)
+            os.close(ftarget)
+
+        if not operation['active']:
+            # Canceled, the file is incomplete
+            os.remove(target)
+            return
+
+        os.utime(target, (info.st_atime, info.st_mtime))
+        self.__add_progress(operation, 0, 1)
+        self.__write_journal(operation, done=source)
+
+        if digest is not None:
+            strategies.add('verify')
+            operation['verify-queue'].put((source, target, digest.digest()))
+
+    def __add_progress(self, operation, size, files=0):
+        with operation['lock']:
+            operation['progress'] += size
+            operation['done-files'] += files
+            now = time.time()
+            interval = now - operation['last-update']
+            if interval < COPY_PROGRESS_INTERVAL:
+                return
+
+            # The throughput is smoothed, so the ETA does not jump
+            speed = (operation['progress'] - operation['last-progress']) / \
+                interval
+
+            if operation['speed']:
+                speed = speed * 0.3 + operation['speed'] * 0.7
+
+            operation['speed'] = speed
+            operation['last-update'] = now
+            operation['last-progress'] = operation['progress']
+            if speed > 0:
+                operation['eta'] = (operation['total-size'] -
+                                    operation['progress']) / speed
+
+        if operation['time-id'] is not None:
+            GObject.idle_add(self.emit, 'progress-changed',
+                             operation['time-id'])
+
+    def __write_journal(self, operation, **entry):
+        if operation['journal'] is None:
+            return
+
+        with operation['lock']:
+            try:
+                operation['journal'].write(json.dumps(entry) + '\n')
+                operation['journal'].flush()
+                if 'done' not in entry:
+                    # A lost "done" entry only copies the file again
+                    os.fdatasync(operation['journal'].fileno())
+
+            except (IOError, OSError, ValueError):
+                pass
+
+    def __close_journal(self, operation, remove=True):
+        # A finished or canceled operation is not resumed, its journal is
+        # removed.
+        if operation['journal'] is None:
+            return
+
+        with operation['lock']:
+            operation['journal'].close()
+            operation['journal'] = None
+
+        if not remove:
+            return
+
+        try:
+            os.remove(get_journal_path(operation['time-id']))
+
+        except OSError:
+            pass
+
+    def __open_journal(self, operation):
+        # The journal is locked while it is used. Returns False if other
+        # instance of the program is using it.
+        try:
+            if not os.path.isdir(JOURNAL_DIR):
+                os.makedirs(JOURNAL_DIR)
+
+            path = get_journal_path(operation['time-id'])
+            exists = os.path.exists(path)
+            operation['journal'] = open(path, 'a')
+
+        except (IOError, OSError):
+            return True
+
+        try:
+            fcntl.flock(operation['journal'], fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except IOError:
+            operation['journal'].close()
+            operation['journal'] = None
+            return False
+
+        if not exists:
+            self.__write_journal(operation, action=operation['action'],
+                                 files=operation['files'],
+                                 destination=operation['destination'],
+                                 parallel=operation['parallel'],
+                                 verify=operation['verify'],
+                                 durability=operation['durability'])
+
+        return True
+
+    def __add_error(self, operation, path, number):
+        operation['errors'].append((path, os.strerror(number)))
+
+    def __make_operation(self, action, files, destination, time_id,
+                         parallel, verify=COPY_VERIFY,
+                         durability=COPY_DURABILITY):
+
+        devices = set()
+        for path in list(files) + [destination]:
+            try:
+                devices.add(os.lstat(path).st_dev)
+
+            except OSError:
+                pass
+
+        return {'action': action,
+                'files': files,
+                'destination': destination,
+                'active': True,
+                'paused': False,
+                'devices': devices,
+                'parallel': parallel,
+                'durability': durability,
+                'clone': COPY_CLONE,
+                'clone-failed': set(),
+                'pools': {},
+                'hardlinks': COPY_HARDLINKS,
+                'verify': verify,
+                'verify-queue': None,
+                'bucket': TokenBucket(),
+                'idle': COPY_IDLE_PRIORITY or action == REMOVE,
+                'inodes': {},
+                'strategies': set(),
+                'lock': thread.allocate_lock(),
+                'time-id': time_id,
+                'total-size': 0,
+                'total-files': 0,
+                'progress': 0,
+                'done-files': 0,
+                'current-file': None,
+                'speed': 0,
+                'eta': None,
+                'last-update': time.time(),
+                'last-progress': 0,
+                'errors': [],
+                'conflicts': [],
+                'journal': None,
+                'resume': {'targets': {},
+                           'temporaries': {},
+                           'moved': set(),
+                           'done': set(),
+                           'offsets': {}}}
+
+    def add_action(self, action, files, destination, time_id,
+                   parallel=COPY_PARALLEL, verify=COPY_VERIFY,
+                   durability=COPY_DURABILITY):
+
+        self.operations[time_id] = self.__make_operation(
+            action, files, destination, time_id, parallel, verify,
+            durability)
+
+        self.__open_journal(self.operations[time_id])
+        self.queue.append(time_id)
+        self.emit('added', time_id)
+        GObject.idle_add(self.__schedule)
+
+    def move(self, path, target):
+        # Moves path to target in this thread, without progress, and
+        # returns the errors.
+        operation = self.__make_operation(
+            CUT, [path], os.path.dirname(target), None, False)
+
+        if same_device(path, os.path.dirname(target)):
+            self.__rename_path(operation, path, target)
+
+        else:
+            entries, errors, size = self.__plan_tree(operation, path, set())
+            self.__move_path(operation, path, target, entries, errors)
+
+        return operation['errors']
+
+    def get_interrupted_operations(self):
+        # Returns the journals of the operations that did not finish
+        if not os.path.isdir(JOURNAL_DIR):
+            return []
+
+        paths = [os.path.join(JOURNAL_DIR, x)
+                 for x in sorted(os.listdir(JOURNAL_DIR))
+                 if x.endswith('.journal')]
+
+        return [x for x in paths
+                if get_journal_time_id(x) not in self.operations and
+                not is_journal_locked(x)]
+
+    def resume_operations(self, paths):
+        for path in paths:
+            try:
+                entries = [json.loads(x, object_hook=encode_strings)
+                           for x in open(path) if x.strip()]
+                header = entries[0]
+                time_id = get_journal_time_id(path)
+
+            except (IOError, ValueError, IndexError):
+                continue
+
+            operation = self.__make_operation(
+                header['action'], header['files'], header['destination'],
+                time_id, header['parallel'], header.get('verify', False),
+                header.get('durability', COPY_DURABILITY))
+
+            resume = operation['resume']
+            for entry in entries[1:]:
+                if 'target' in entry:
+                    resume['targets'][entry['item']] = entry['target']
+
+                elif 'temporary' in entry:
+                    resume['temporaries'][entry['item']] = entry['temporary']
+
+                elif 'moved' in entry:
+                    resume['moved'].add(entry['moved'])
+
+                elif 'done' in entry:
+                    resume['done'].add(entry['done'])
+
+                elif 'offset' in entry:
+                    # [offset, size, mtime], the size and the mtime of the
+                    # source when the offset was written.
+                    resume['offsets'][entry['offset'][0]] = entry['offset'][1:]
+
+            if not self.__open_journal(operation):
+                continue  # Resumed by other instance
+
+            self.operations[time_id] = operation
+            self.queue.append(time_id)
+            self.emit('added', time_id)
+
+        GObject.idle_add(self.__schedule)
+
+    def get_pending_files(self):
+        # The files of the running and waiting operations, and of the
+        # interrupted ones that can still be resumed
+        files = set()
+        for operation in self.operations.values():
+            if operation['active']:
+                files.update(operation['files'])
+
+        for path in self.get_interrupted_operations():
+            try:
+                with open(path) as journal:
+                    header = json.loads(journal.readline(),
+                                        object_hook=encode_strings)
+
+                files.update(header['files'])
+
+            except (IOError, ValueError, KeyError):
+                continue
+
+        return files
+
+    def discard_operations(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+
+            except OSError:
+                pass
+
+    def cancel_operation(self, time_id):
+        self.operations[time_id]['active'] = False
+        if time_id in self.queue:
+            self.__close_journal(self.operations[time_id])
+            self.__operation_ended(time_id)
+
+    def pause_operation(self, time_id):
+        self.operations[time_id]['paused'] = True
+        self.emit('queue-changed')
+
+    def resume_operation(self, time_id):
+        self.operations[time_id]['paused'] = False
+        self.__schedule()
+
+    def move_operation(self, time_id, offset):
+        # Moves a waiting operation offset places in the queue
+        if time_id not in self.queue:
+            return
+
+        idx = self.queue.index(time_id)
+        idx = max(0, min(idx + offset, len(self.queue) - 1))
+        self.queue.remove(time_id)
+        self.queue.insert(idx, time_id)
+        self.__schedule()
+
+    def __getitem__(self, time_id):
+        return self.operations[time_id]
+
+
+class TrashManager(GObject.GObject):
+
+    __gsignals__ = {
+        'files-changed': (GObject.SIGNAL_RUN_FIRST, None, [object]),
+        'sizes-changed': (GObject.SIGNAL_RUN_FIRST, None, []),
+        'error': (GObject.SIGNAL_RUN_FIRST, None, [int]),
+        }
+
+    def __init__(self, ccpmanager=None):
+        GObject.GObject.__init__(self)
+
+        self.files = {}
+        self.home = os.path.dirname(TRASH_DIR.rstrip('/'))
+
+        # {trash folder: top folder of its mount, None for the home trash}.
+        # The trash of a mount is used for its files, so moving them to
+        # the trash is always a rename.
+        self.trashes = {self.home: None}
+
+        self.sizes = {}  # {trash folder: {name: (size, mtime)}}
+        self.changed_sizes = set()
+        self.measuring = set()  # Folders whose size is counted in a thread
+        self.ccpmanager = ccpmanager or CCPManager()
+        self.can_scan = True
+        self.timeout = None
+        self.monitors = []
+        self.scan_id = None
+        self.update_id = None
+
+        # {info path: ((mtime, size), data or None)}, the .trashinfo files
+        # are only parsed again when they change.
+        self.index = {}
+
+    def start(self, timeout=500, leftovers=True):
+        # The changes are followed with monitors of the info folders, and
+        # if they can not be created, polling every timeout milliseconds.
+        # With leftovers, the staging folders left by other emptyings are
+        # removed.
+        self.stop()
+        self.update_trashes()
+        if leftovers:
+            self.__remove_leftovers()
+
+        self.scan_id = GObject.idle_add(self.__initial_scan)
+
+        try:
+            for trash in self.trashes:
+                gfile = Gio.File.new_for_path(os.path.join(trash, 'info'))
+                monitor = gfile.monitor_directory(
+                    Gio.FileMonitorFlags.NONE, None)
+
+                monitor.connect('changed', self.__info_changed)
+                self.monitors.append(monitor)
+
+        except GLib.Error:
+            self.timeout = GObject.timeout_add(timeout, self.scan)
+
+    def stop(self):
+        for monitor in self.monitors:
+            monitor.cancel()
+
+        self.monitors = []
+
+        if self.timeout is not None:
+            GObject.source_remove(self.timeout)
+            self.timeout = None
+
+        if self.scan_id is not None:
+            GObject.source_remove(self.scan_id)
+            self.scan_id = None
+
+        if self.update_id is not None:
+            GObject.source_remove(self.update_id)
+            self.update_id = None
+
+        self.files = {}
+
+    def update_trashes(self):
+        # Finds the trashes of the mounted volumes, without creating them
+        trashes = {self.home: None}
+        for folder in get_mount_points():
+            if same_device(folder, TRASH_PARENT_DIR):
+                continue
+
+            trash = get_top_trash(folder)
+            if trash is not None:
+                trashes[trash] = folder
+
+        self.trashes = trashes
+
+    def __remove_leftovers(self):
+        # The staging folders of a cancelled, discarded or failed emptying
+        # would use space forever, so their removal is started again.
+        pending = self.ccpmanager.get_pending_files()
+        staged = []
+        for trash in self.trashes:
+            try:
+                names = os.listdir(trash)
+
+            except OSError:
+                continue
+
+            staged.extend([os.path.join(trash, x) for x in names
+                           if x.startswith(TRASH_STAGING_PREFIX) and
+                           os.path.join(trash, x) not in pending])
+
+        self.__remove_staged(staged)
+
+    def __remove_staged(self, staged):
+        if staged:
+            self.ccpmanager.add_action(REMOVE, staged, self.home, time.time(),
+                                       durability=DURABILITY_NONE)
+
+    def get_trash(self, path):
+        # Returns (trash folder, top folder) for path. The files of other
+        # devices go to the trash of their mount, created if needed, and
+        # only if that is not possible they are copied to the home trash.
+        if same_device(path, TRASH_PARENT_DIR):
+            self.__make_home_trash()
+            return self.home, None
+
+        top = get_mount_point(path)
+        trash = get_top_trash(top, create=True)
+        if trash is None:
+            self.__make_home_trash()
+            return self.home, None
+
+        self.trashes[trash] = top
+        return trash, top
+
+    def move_to(self, paths):
+        for path in paths:
+            path = get_real_path(path)
+            trash, top = self.get_trash(path)
+            files_path = os.path.join(trash, 'files')
+            info_path = os.path.join(trash, 'info')
+
+            readable, writable = get_access(path)
+            readable1, writable1 = get_access(files_path)
+            readable2, writable2 = get_access(info_path)
+
+            if not writable or not writable1 or not writable2:
+                #self.emit('error')
+                continue
+
+            new_path = get_copy_name(os.path.join(files_path, get_name(path)))
+            name = get_name(new_path)
+            info_path = os.path.join(info_path, name) + '.trashinfo'
+
+            if self.ccpmanager.move(path, new_path):
+                #self.emit('error')
+                continue
+
+            if top is not None:
+                # The trashes of the mounts keep the paths relative to the
+                # top folder, so they work wherever the volume is mounted.
+                path = os.path.relpath(path, top)
+
+            info_file = open(info_path, 'w')
+            cfg = ConfigParser.ConfigParser()
+
+            cfg.add_section('Trash Info')
+            cfg.set('Trash Info', 'Path', path)
+            cfg.set('Trash Info', 'DeletionDate', get_current_time())
+            cfg.write(info_file)
+            info_file.close()
+
+            if os.path.isdir(new_path) and not os.path.islink(new_path):
+                # The size is known from now, not the next time that the
+                # trash is shown.
+                self.__measure(new_path)
+
+    def remove_paths(self, paths):
+        for path in paths:
+            trash, name, info_path = self.__get_item_paths(path)
+            try:
+                remove_path(path.rstrip('/'))
+                os.remove(info_path)
+
+            except OSError:
+                #self.emit('error')
+                continue
+
+            self.__drop_size(trash, name)
+
+        self.__save_sizes()
+
+    def clear(self):
+        # The files and info folders of each trash are renamed to a staging
+        # folder, so the trash is empty at once, and the staged trees are
+        # removed in the background by the CCPManager, with progress and
+        # idle I/O priority. If the program is closed, the removal is
+        # resumed like any other operation.
+        staged = []
+        for trash in self.trashes:
+            try:
+                staging = tempfile.mkdtemp(prefix=TRASH_STAGING_PREFIX,
+                                           dir=trash)
+
+                for name in ['info', 'files']:
+                    os.rename(os.path.join(trash, name),
+                              os.path.join(staging, name))
+
+                    os.mkdir(os.path.join(trash, name), 0700)
+
+            except OSError:
+                #self.emit('error')
+                continue
+
+            staged.append(staging)
+            self.sizes[trash] = {}
+            self.changed_sizes.add(trash)
+
+        self.__save_sizes()
+        self.__remove_staged(staged)
+
+        if self.monitors:
+            # The monitors followed the renamed info folders
+            self.start(leftovers=False)
+
+        else:
+            self.scan()
+
+    def restore(self, paths):
+        for path in paths:
+            trash, name, info_path = self.__get_item_paths(path)
+            data = self.__read_info(info_path)
+            if data is None:
+                # self.emit('error')
+                continue
+
+            save_path = data['path']
+            parent_directory = get_parent_directory(save_path)
+            readable, writable = get_access(parent_directory)
+            if not writable:
+                # self.emit('error')
+                continue
+
+            os.rename(path.rstrip('/'), save_path.rstrip('/'))
+            self.__drop_size(trash, name)
+
+        self.__save_sizes()
+
+    def get_item_size(self, real_file):
+        # The bytes used by an item of the trash. The sizes of the folders
+        # are kept in the directorysizes file of each trash (from the trash
+        # specification), and they are valid while the mtime of their
+        # .trashinfo files does not change. The folders without a valid
+        # size are counted in a thread, and sizes-changed is emitted when
+        # their sizes are known, meanwhile the old size (or 0) is returned.
+        try:
+            info = os.lstat(real_file)
+
+        except OSError:
+            return 0
+
+        if not stat.S_ISDIR(info.st_mode):
+            return get_allocated_size(info)
+
+        trash, name, info_path = self.__get_item_paths(real_file)
+
+        try:
+            mtime = int(os.stat(info_path).st_mtime)
+
+        except OSError:
+            return 0  # Not an item of the trash
+
+        size, saved_mtime = self.__load_sizes(trash).get(name, (0, None))
+        if saved_mtime != mtime:
+            self.__measure(real_file)
+
+        return size
+
+    def get_total_size(self):
+        size = 0
+        for data in self.files.values():
+            size += self.get_item_size(data['real-file'])
+
+        return size
+
+    def __measure(self, real_file):
+        real_file = real_file.rstrip('/')
+        if real_file in self.measuring:
+            return
+
+        self.measuring.add(real_file)
+        thread.start_new_thread(self.__measure_thread, (real_file,))
+
+    def __measure_thread(self, real_file):
+        trash, name, info_path = self.__get_item_paths(real_file)
+        try:
+            # Before the walk, so a later change makes the size invalid
+            mtime = int(os.stat(info_path).st_mtime)
+
+        except OSError:
+            mtime = None
+
+        size = get_disk_usage(real_file)
+        GObject.idle_add(self.__set_size, real_file, size, mtime)
+
+    def __set_size(self, real_file, size, mtime):
+        self.measuring.discard(real_file)
+        if mtime is not None:
+            trash, name, info_path = self.__get_item_paths(real_file)
+            self.__load_sizes(trash)[name] = (size, mtime)
+            self.changed_sizes.add(trash)
+            self.__save_sizes()
+
+        self.emit('sizes-changed')
+        return False
+
+    def __make_home_trash(self):
+        for path in [TRASH_DIR, TRASH_INFO_DIR]:
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+
+                except:
+                    print 'error creating %s' % path
+                    return False
+
+        return True
+
+    def __get_item_paths(self, real_file):
+        # Returns (trash folder, name, info path) of an item of a trash
+        files_path, name = os.path.split(real_file.rstrip('/'))
+        trash = os.path.dirname(files_path)
+        info_path = os.path.join(trash, 'info', name) + '.trashinfo'
+        return trash, name, info_path
+
+    def __load_sizes(self, trash):
+        if trash not in self.sizes:
+            self.sizes[trash] = read_directory_sizes(
+                os.path.join(trash, 'directorysizes'))
+
+        return self.sizes[trash]
+
+    def __drop_size(self, trash, name):
+        if self.__load_sizes(trash).pop(name, None) is not None:
+            self.changed_sizes.add(trash)
+
+    def __save_sizes(self):
+        for trash in list(self.changed_sizes):
+            try:
+                write_directory_sizes(os.path.join(trash, 'directorysizes'),
+                                      self.sizes[trash])
+
+                self.changed_sizes.remove(trash)
+
+            except (OSError, IOError):
+                pass  # It is only a cache
+
+    def scan(self):
+        if not self.__make_home_trash():
+            return False
+
+        paths = set()
+        for trash in self.trashes:
+            folder = os.path.join(trash, 'info')
+            try:
+                paths.update([os.path.join(folder, x)
+                              for x in os.listdir(folder)
+                              if x.endswith('.trashinfo')])
+
+            except OSError:
+                pass  # The volume was removed
+
+        for info_path in self.index.keys():
+            if info_path not in paths:
+                del self.index[info_path]
+
+        for info_path in paths:
+            self.__update_entry(info_path)
+
+        self.__update_files()
+        return True
+
+    def __initial_scan(self):
+        # Only once, the monitors (or the timeout) follow the changes
+        self.scan_id = None
+        self.scan()
+        return False
+
+    def __info_changed(self, monitor, gfile, other_gfile, event):
+        info_path = gfile.get_path()
+        if not info_path or not info_path.endswith('.trashinfo'):
+            return
+
+        if self.__update_entry(info_path) and self.update_id is None:
+            # Trashing many files sends many events, the view is updated
+            # once for all of them.
+            self.update_id = GObject.idle_add(self.__update_files)
+
+    def __update_entry(self, info_path):
+        # Parses info_path if it is new or changed, and returns if the
+        # index changed.
+        try:
+            info = os.stat(info_path)
+
+        except OSError:
+            return self.index.pop(info_path, None) is not None
+
+        key = (info.st_mtime, info.st_size)
+        if info_path in self.index and self.index[info_path][0] == key:
+            return False
+
+        self.index[info_path] = (key, self.__read_info(info_path))
+        return True
+
+    def __read_info(self, info_path):
+        trash = os.path.dirname(os.path.dirname(info_path))
+        name = get_name(info_path)[:-10]
+        real_file = os.path.join(trash, 'files', name)
+
+        cfg = ConfigParser.ConfigParser()
+        try:
+            cfg.read([info_path])
+
+        except ConfigParser.Error:
+            return None
+
+        if not cfg.has_option('Trash Info', 'Path'):
+            return None
+
+        path = cfg.get('Trash Info', 'Path')
+        top = self.trashes.get(trash)
+        if top is not None:
+            path = os.path.join(top, path)
+
+        data = {'path': clear_path(path),
+                'real-file': clear_path(real_file)}
+
+        if cfg.has_option('Trash Info', 'DeletionDate'):
+            data['deletion-date'] = cfg.get('Trash Info', 'DeletionDate')
+
+        return data
+
+    def __update_files(self):
+        self.update_id = None
+        files = dict([(info_path, data)
+                      for info_path, (key, data) in self.index.items()
+                      if data is not None])
+
+        if files != self.files:
+            self.files = files
+            self.emit('files-changed', files)
+
+        return False
+
+
+def normalize_name(name):
+    # Decompose the characters (NFKD) and drop the combining marks, so 'Á'
+    # and 'ñ' are found writing 'a' and 'n'.
+    if type(name) == str:
+        name = name.decode('utf-8', 'replace')
+
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join([x for x in name if not unicodedata.combining(x)])
+
+    if hasattr(name, 'casefold'):
+        return name.casefold()
+
+    return name.lower()
+
+
+def list_directory(folder):
+    # Returns a list of (name, path, is_dir), symbolic links to directories
+    # are not marked as directories so they are never followed.
+    items = []
+    try:
+        if scandir is not None:
+            for entry in scandir(folder):
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+
+                except OSError:
+                    is_dir = False
+
+                items.append((entry.name, entry.path, is_dir))
+
+            return items
+
+        if readdir is not None:
+            return read_directory(folder)
+
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                is_dir = stat.S_ISDIR(os.lstat(path).st_mode)
+
+            except OSError:
+                is_dir = False
+
+            items.append((name, path, is_dir))
+
+    except OSError:
+        pass
+
+    return items
+
+
+def read_directory(folder):
+    # list_directory with readdir, only the file systems that do not give
+    # the type of the entries need a lstat.
+    directory = libc.opendir(folder)
+    if not directory:
+        number = ctypes.get_errno()
+        raise OSError(number, os.strerror(number), folder)
+
+    items = []
+    try:
+        while True:
+            entry = readdir(directory)
+            if not entry:
+                break
+
+            entry = entry.contents
+            name = entry.d_name
+            if name == '.' or name == '..':
+                continue
+
+            path = os.path.join(folder, name)
+            is_dir = entry.d_type == DT_DIR
+            if entry.d_type == DT_UNKNOWN:
+                try:
+                    is_dir = stat.S_ISDIR(os.lstat(path).st_mode)
+
+                except OSError:
+                    is_dir = False
+
+            items.append((name, path, is_dir))
+
+    finally:
+        libc.closedir(directory)
+
+    return items
+
+
+def walk_files(folder, show_hidden_files=False, same_mount=True):
+    # Yields the path of every regular file under folder
+    device = os.stat(folder).st_dev if same_mount else None
+    stack = [folder]
+
+    while stack:
+        for name, path, is_dir in list_directory(stack.pop()):
+            if (name.startswith('.') or name.endswith('~')) and \
+                    not show_hidden_files:
+                continue
+
+            try:
+                info = os.lstat(path)
+
+            except OSError:
+                continue
+
+            if is_dir:
+                if device is None or info.st_dev == device:
+                    stack.append(path)
+
+            elif stat.S_ISREG(info.st_mode):
+                yield path
+
+
+def get_literal(regex):
+    # Returns the longest text that any match of regex must contain, used to
+    # discard files without reading them line by line.
+    try:
+        parsed = sre_parse.parse(regex)
+
+    except (re.error, sre_constants.error):
+        return ''
+
+    if parsed.pattern.flags & re.IGNORECASE:
+        return ''
+
+    literal = ''
+    current = ''
+    for op, value in parsed:
+        if op == sre_constants.LITERAL and value < 256:
+            current += chr(value)
+
+        else:
+            literal = max(literal, current, key=len)
+            current = ''
+
+    return max(literal, current, key=len)
+
+
+def get_glob_pattern(text):
+    # The regular expression of a glob, without the anchor at the end and
+    # without the DOTALL flag, so it matches a part of a line.
+    pattern = fnmatch.translate(text)
+    if pattern.endswith('\\Z(?ms)'):
+        pattern = pattern[:-len('\\Z(?ms)')]
+
+    elif pattern.startswith('(?s:') and pattern.endswith(')\\Z'):
+        pattern = pattern[len('(?s:'):-len(')\\Z')]
+
+    return pattern
+
+
+def grep_files(args):
+    # Runs in the processes (or the threads) of ContentSearch
+    paths, text, mode, max_size, slot = args
+    matches = []
+
+    for path in paths:
+        if slot is not None and search_cancelled[slot]:
+            break
+
+        try:
+            matches.extend(grep_file(path, text, mode, max_size))
+
+        except (IOError, OSError, ValueError, mmap.error):
+            continue
+
+    return matches
+
+
+def grep_file(path, text, mode=SEARCH_SUBSTRING, max_size=None):
+    size = os.path.getsize(path)
+    if not size or (max_size and size > max_size):
+        return []
+
+    _file = open(path, 'rb')
+    try:
+        if '\0' in _file.read(1024):
+            return []  # Binary file
+
+        data = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    finally:
+        _file.close()
+
+    try:
+        searched = data
+        if mode == SEARCH_REGEX:
+            pattern = text
+
+        else:
+            # Like the names, the case is ignored, and a glob matches a part
+            # of a line. A copy in lower case is searched, that is faster
+            # than re.IGNORECASE.
+            pattern = re.escape(text.lower())
+            if mode == SEARCH_GLOB:
+                pattern = get_glob_pattern(text.lower())
+
+            searched = data[:].lower()
+
+        regex = re.compile(pattern, re.MULTILINE)
+        literal = get_literal(pattern)
+
+        # Most of the files do not contain the text, find is faster than a
+        # regular expression to discard them.
+        if literal and searched.find(literal) < 0:
+            return []
+
+        matches = []
+        line = 1
+        counted = 0
+        for match in regex.finditer(searched):
+            start = searched.rfind('\n', 0, match.start()) + 1
+            end = searched.find('\n', match.start())
+            end = size if end < 0 else end
+
+            line += searched[counted:start].count('\n')
+            counted = start
+            if matches and matches[-1][1] == line:
+                continue  # Other match in the same line
+
+            matches.append((path, line, data[start:end][:200].strip()))
+            if len(matches) >= CONTENT_SEARCH_MAX_MATCHES:
+                break
+
+        return matches
+
+    finally:
+        data.close()
+
+
+def get_name_matcher(text, mode=SEARCH_SUBSTRING):
+    # Returns a function that checks if a file name matches with text,
+    # ignoring the case.
+    if mode == SEARCH_GLOB:
+        return re.compile(fnmatch.translate(text), re.IGNORECASE).match
+
+    elif mode == SEARCH_REGEX:
+        return re.compile(text, re.IGNORECASE).search
+
+    text = text.lower()
+    return lambda name: text in name.lower()
+
+
+def fuzzy_score(text, key):
+    # Scores a subsequence match of text in key (both in lower case) like fzf
+    # does: each character adds points, with bonuses for consecutive
+    # characters and for characters at the start of a word, and with
+    # penalties for the gaps. Returns None if text is not a subsequence.
+    position = -1
+    for char in text:
+        position = key.find(char, position + 1)
+        if position < 0:
+            return None
+
+    # Go back from the end of the first match, to use the shortest part of
+    # key that contains text.
+    end = position + 1
+    for char in reversed(text):
+        end = key.rfind(char, 0, end)
+
+    name_start = key.rfind('/') + 1
+    position = end - 1
+    previous = None
+    score = 0
+
+    for char in text:
+        position = key.find(char, position + 1)
+        score += 16
+
+        if position == 0 or key[position - 1] in '/':
+            score += 10
+
+        elif key[position - 1] in ' _-.':
+            score += 8
+
+        if position >= name_start:
+            score += 2
+
+        if previous is not None:
+            if position == previous + 1:
+                score += 8
+
+            else:
+                score -= 3 + (position - previous - 2)
+
+        previous = position
+
+    return score
+
+
+def copy_file_range(source, destination, count):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(source, destination, count)
+
+    if libc is None or not hasattr(libc, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    size = libc.copy_file_range(source, None, destination, None, count, 0)
+    if size < 0:
+        number = ctypes.get_errno()
+        raise OSError(number, os.strerror(number))
+
+    return size
+
+
+def sendfile(destination, source, count):
+    if hasattr(os, 'sendfile'):
+        return os.sendfile(destination, source, None, count)
+
+    if libc is None or not hasattr(libc, 'sendfile'):
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+    size = libc.sendfile(destination, source, None, count)
+    if size < 0:
+        number = ctypes.get_errno()
+        raise OSError(number, os.strerror(number))
+
+    return size
+
+
+def clone_file(source, destination, offset=0):
+    # Makes destination share the data of source from offset to the end,
+    # returns False if the file system can not do it.
+    try:
+        if offset:
+            fcntl.ioctl(destination, FICLONERANGE,
+                        struct.pack('qQQQ', source, offset, 0, offset))
+
+        else:
+            fcntl.ioctl(destination, FICLONE, source)
+
+        return True
+
+    except (IOError, OSError) as error:
+        if error.errno not in CLONE_FALLBACK_ERRORS:
+            raise
+
+        return False
+
+
+def copy_file_data(source, destination, strategies=None, length=None,
+                   digest=None, chunk=None):
+    """
+    Copies the data from the file descriptor source to destination, from
+    their current offsets and up to length bytes, yielding the number of
+    bytes of each chunk written. The data is copied inside the kernel when
+    it is possible (with copy_file_range, then sendfile), and else with a
+    buffer. The name of the method used is added to strategies.
+    If digest is given, the data is copied with the buffer and hashed.
+    If chunk is given, it is called before each chunk and returns its
+    maximum size.
+    """
+
+    strategies = strategies if strategies is not None else set()
+    remaining = [length]
+
+    def get_count(maximum):
+        if chunk is not None:
+            maximum = min(maximum, chunk())
+
+        if remaining[0] is None:
+            return maximum
+
+        return min(maximum, remaining[0])
+
+    def written(size):
+        if remaining[0] is not None:
+            remaining[0] -= size
+
+        return size
+
+    calls = [('copy_file_range',
+              lambda: copy_file_range(source, destination,
+                                      get_count(COPY_CHUNK_SIZE))),
+             ('sendfile',
+              lambda: sendfile(destination, source,
+                               get_count(COPY_CHUNK_SIZE)))]
+
+    for name, call in calls if digest is None else []:
+        try:
+            size = call() if get_count(1) else 0
+            strategies.add(name)
+            while size:
+                yield written(size)
+                size = call() if get_count(1) else 0
+
+            return
+
+        except OSError as error:
+            if error.errno not in COPY_FALLBACK_ERRORS:
+                raise
+
+    fsource = io.FileIO(source, 'r', closefd=False)
+    fdestination = io.FileIO(destination, 'w', closefd=False)
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    strategies.add('buffer')
+
+    size = fsource.readinto(view[:get_count(COPY_BUFFER_SIZE)])
+    while size:
+        if digest is not None:
+            digest.update(view[:size])
+
+        done = 0
+        while done < size:
+            done += fdestination.write(view[done:size])
+
+        yield written(size)
+        size = fsource.readinto(view[:get_count(COPY_BUFFER_SIZE)])
+
+
+def copy_sparse_file_data(source, destination, end, strategies=None,
+                          digest=None, chunk=None):
+    # Like copy_file_data, but only the data extents before end are copied,
+    # the holes are skipped (the caller must truncate destination to the
+    # size of the file). The holes are hashed as zeros.
+    strategies = strategies if strategies is not None else set()
+    position = os.lseek(source, 0, os.SEEK_CUR)
+
+    while position < end:
+        try:
+            data = os.lseek(source, position, SEEK_DATA)
+
+        except OSError as error:
+            if error.errno == errno.ENXIO:  # Only a hole until the end
+                update_digest_with_zeros(digest, end - position)
+                return
+
+            elif error.errno != errno.EINVAL:
+                raise
+
+            # The file system does not report the holes
+            for size in copy_file_data(source, destination, strategies,
+                                       digest=digest, chunk=chunk):
+                yield size
+
+            return
+
+        hole = os.lseek(source, data, SEEK_HOLE)
+        os.lseek(source, data, os.SEEK_SET)
+        os.lseek(destination, data, os.SEEK_SET)
+        update_digest_with_zeros(digest, data - position)
+        strategies.add('sparse')
 
-                return get_name(path)
+        for size in copy_file_data(source, destination, strategies,
+                                   hole - data, digest, chunk):
+            yield size
 
-    def __setitem__(self, name, value):
-        if not name in self[name]:
-            if '/' in name:
-                self.dirs.append(name)
-                self.names.append(value)
+        position = hole
 
-            else:
-                self.names.append(name)
-                self.dirs.append(value)
 
-        else:
-            if name in self.dirs:
-                self.names[self.dirs.index(name)] = value
+def update_digest(digest, fd, length=None):
+    # Hashes the data of fd from its offset, up to length bytes
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    fdata = io.FileIO(fd, 'r', closefd=False)
+    while length is None or length > 0:
+        count = COPY_BUFFER_SIZE if length is None else \
+            min(COPY_BUFFER_SIZE, length)
 
-            elif name in self.names:
-                self.dirs[self.names.index(name)] = value
+        size = fdata.readinto(view[:count])
+        if not size:
+            break
 
-    def __iter__(self):
-        for x in self.dirs:
-            yield x
+        digest.update(view[:size])
+        if length is not None:
+            length -= size
 
-    def __contains__(self, name):
-        if name in self.dirs + self.names:
-            return True
 
-        if clear_path(name) in self.mounts:
-            return True
+def update_digest_with_zeros(digest, length):
+    if digest is None:
+        return
 
-        for x in self.dirs:
-            if not x.endswith('/'):
-                x += '/'
+    zeros = bytearray(min(length, COPY_BUFFER_SIZE))
+    while length > 0:
+        size = min(length, len(zeros))
+        digest.update(memoryview(zeros)[:size])
+        length -= size
 
-            if not name.endswith('/'):
-                name += '/'
 
-            if name == x:
-                return True
+def get_file_digest(path):
+    # Hashes the file from the device: its pages are dropped from the
+    # cache first (it must be synced).
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fadvise_dont_need(fd)
+        digest = hashlib.new(COPY_VERIFY_HASH)
+        update_digest(digest, fd)
+        return digest.digest()
 
-        return False
+    finally:
+        os.close(fd)
 
-    def get_pixbuf_symbolic(self, path):
-        screen = Gdk.Screen.get_default()
-        icon_theme = Gtk.IconTheme.get_for_screen(screen)
-        return icon_theme.load_icon(
-            self.symbolic_icons[path], DEFAULT_ITEM_ICON_SIZE, 0)
 
-    def add_mount(self, path):
-        if not clear_path(path) in self.mounts:
-            self.mounts.append(clear_path(path))
+def set_io_priority(idle):
+    # Changes the I/O priority of the calling thread: the idle class, or
+    # the default of the process.
+    syscalls = IOPRIO_SYSCALLS.get(platform.machine())
+    if libc is None or syscalls is None:
+        return False
 
-    def remove_mount(self, path):
-        if clear_path(path) in self.mounts:
-            self.mounts.remove(clear_path(path))
+    ioprio_set, gettid = syscalls
+    priority = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT if idle else 0
+    tid = libc.syscall(gettid)
+    return libc.syscall(ioprio_set, IOPRIO_WHO_PROCESS, tid, priority) == 0
 
 
-class ScanFolder(GObject.GObject):
+def fadvise_dont_need(fd):
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
 
-    __gsignals__ = {
-        'files-changed': (GObject.SIGNAL_RUN_FIRST, None, [object]),
-        'realized-searching': (GObject.SIGNAL_RUN_FIRST, None, []),
-        }
+    elif libc is not None and hasattr(libc, 'posix_fadvise'):
+        libc.posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
 
-    def __init__(self, folder, timeout=500):
 
-        GObject.GObject.__init__(self)
+def get_allocated_size(info):
+    # The bytes of a file that are not holes
+    if hasattr(info, 'st_blocks'):
+        return min(info.st_size, info.st_blocks * 512)
 
-        self.folder = folder
-        self.files = []
-        self.show_hidden_files = False
-        self.can_scan = True
-        self.mounts = {}
+    return info.st_size
 
-        GObject.timeout_add(timeout, self.scan)
 
-    def scan(self, force=False):
-        if not self.can_scan:
-            return True
+def is_sparse(info):
+    return get_allocated_size(info) < info.st_size
 
-        files = []
-        directories = []
 
-        if (self.files != self.get_files()) or force:
-            self.files = self.get_files()
+def get_disk_usage(path):
+    # The bytes used by the tree of path, the hard links counted once
+    inodes = set()
+    size = 0
 
-            self.emit('files-changed', self.files)
+    for source, relative, info, number in walk_tree(path):
+        if info is None:
+            continue
 
-        self.emit('realized-searching')
+        if info.st_nlink > 1 and not stat.S_ISDIR(info.st_mode):
+            if (info.st_dev, info.st_ino) in inodes:
+                continue
 
-        return True
+            inodes.add((info.st_dev, info.st_ino))
 
-    def set_folder(self, folder):
-        self.folder = folder
-        GObject.idle_add(self.scan)
+        size += get_allocated_size(info)
 
-    def get_files(self):
-        directories = []
-        files = []
-        if os.path.isdir(self.folder):
-            _files = os.listdir(self.folder)
+    return size
 
-        else:
-            self.folder = get_parent_directory(self.folder)
-            return
 
-        for name in _files:
-            filename = clear_path(os.path.join(self.folder, name))
+def read_directory_sizes(path):
+    # Returns {name: (size, mtime)} from a directorysizes file, with lines
+    # "size mtime percent-encoded-name".
+    sizes = {}
+    try:
+        with open(path) as _file:
+            for line in _file:
+                fields = line.split()
+                if len(fields) != 3 or not fields[0].isdigit() or \
+                        not fields[1].isdigit():
+                    continue
 
-            if (not name.startswith('.') and not name.endswith('~')) or \
-                    self.show_hidden_files:
+                name = urllib.unquote(fields[2])
+                sizes[name] = (int(fields[0]), int(fields[1]))
 
-                if os.path.isdir(filename):
-                    directories.append(filename)
+    except IOError:
+        pass
 
-                elif os.path.isfile(filename):
-                    files.append(filename)
+    return sizes
 
-        directories = natural_sort(directories)
-        files = natural_sort(files)
 
-        return directories + files
+def write_directory_sizes(path, sizes):
+    # The file is replaced with a rename, so it is never read half written
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(descriptor, 'w') as _file:
+            for name, (size, mtime) in sorted(sizes.items()):
+                _file.write('%d %d %s\n' % (size, mtime, urllib.quote(name)))
 
-    def set_show_hidden_files(self, if_show):
-        if type(if_show) != bool:
-            raise TypeError(_('The parameter must to be a bool'))
+        os.rename(temporary, path)
 
-        self.show_hidden_files = if_show
-        GObject.idle_add(self.scan)
+    except:
+        remove_path(temporary, ignore_errors=True)
+        raise
 
 
-class CCPManager(GObject.GObject):
-    # Cut, Copy and Paste
+def encode_strings(value):
+    # json returns unicode strings, and the paths are used as str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
 
-    __gsignals__ = {
-        'error': (GObject.SIGNAL_RUN_FIRST, None, [int]),
-        'warning': (GObject.SIGNAL_RUN_FIRST, None, [str]),
-        'start': (GObject.SIGNAL_RUN_FIRST, None, [float]),
-        'progress-changed': (GObject.SIGNAL_RUN_FIRST, None, [float]),
-        'end': (GObject.SIGNAL_RUN_FIRST, None, [float]),
-        }
+    elif isinstance(value, list):
+        return [encode_strings(x) for x in value]
 
-    def __init__(self):
-        GObject.GObject.__init__(self)
+    elif isinstance(value, dict):
+        return dict([(encode_strings(key), encode_strings(x))
+                     for key, x in value.items()])
 
-        self.operations = {}
-        # Operations structur:
-        #    {time_id: {'action': int,
-        #               'files': list,
-        #               'destination': str,
-        #               'active': bool,
-        #               'total-size': int,
-        #               'progress': int}}
+    return value
 
-    def __start_new_operation(self, time_id):
-        operation = self.operations[time_id]
 
-        def start():
-            self.emit('start', time_id)
-
-            actual = 0
-            loop_time = 1
-            action = operation['action']
-            files = operation['files']
-            operation['total-size'] = get_total_size(files)
-            operation['progress'] = 0
-
-            while operation['active']:
-                path = files[actual]
-                actual += 1
-                readable, writable = get_access(path)
-                if (not readable and action == COPY) or \
-                    (not writable and action == CUT):
-
-                    #self.emit('error', 1)
-                    #return
-                    continue
+def get_journal_path(time_id):
+    return os.path.join(JOURNAL_DIR, '%r.journal' % time_id)
 
-                if operation['action'] == COPY:
-                    command = 'cp -r %s' % path
 
-                elif operation['action'] == CUT:
-                    command = 'mv -r %s' % path
+def is_journal_locked(path):
+    # A journal is locked by the instance of the program that runs its
+    # operation.
+    try:
+        with open(path) as journal:
+            fcntl.flock(journal, fcntl.LOCK_SH | fcntl.LOCK_NB)
 
-                os.system(command)
+    except IOError as error:
+        return error.errno in (errno.EWOULDBLOCK, errno.EAGAIN)
 
-                if actual == len(files):
-                    operation[active] = False
+    return False
 
-                if actual % 2:
-                    operacion['progress'] = get_total_size(operacion['destination'])
-                    self.emit('progress-changed', time_id)
 
-            self.emit('end', time_id)
+def get_journal_time_id(path):
+    return float(get_name(path)[:-len('.journal')])
 
-        readable, writable = get_access(operation[2])
-        if not writable:
-            #self.emit('error', 0)
-            return
 
-        thread.start_new_thread(start, ())
+def get_mount_points():
+    # The folders where a file system is mounted, from /proc/mounts
+    folders = []
+    try:
+        with open('/proc/mounts') as _file:
+            for line in _file:
+                fields = line.split()
+                if len(fields) > 1:
+                    # The spaces are written as octal escapes (\040)
+                    folders.append(fields[1].decode('string_escape'))
 
-    def add_action(self, action, files, destination, time_id):
-        self.operations[time_id] = {'action': action,
-                                    'files': files,
-                                    'destination': destination,
-                                    'active': True}
+    except IOError:
+        pass
 
-        GObject.idle_add(self.__start_new_operation, time_id)
+    return folders
 
-    def cancel_operation(self, time_id):
-        self.operations[time_id]['active'] = False
 
-    def __getitem__(self, time_id):
-        return self.operations[time_id]
+def get_real_path(path):
+    # Resolves the links of the parent folders, but not path itself
+    path = path.rstrip('/') or '/'
+    return os.path.join(os.path.realpath(os.path.dirname(path)),
+                        os.path.basename(path))
 
 
-class TrashManager(GObject.GObject):
+def get_mount_point(path):
+    # The top folder of the file system of path, a link is not followed
+    path = get_real_path(path)
+    device = os.lstat(path).st_dev
 
-    __gsignals__ = {
-        'files-changed': (GObject.SIGNAL_RUN_FIRST, None, [object]),
-        'error': (GObject.SIGNAL_RUN_FIRST, None, [int]),
-        }
+    while path != '/':
+        parent = os.path.dirname(path)
+        if os.lstat(parent).st_dev != device:
+            break
 
-    def __init__(self):
-        GObject.GObject.__init__(self)
+        path = parent
 
-        self.files = {}
-        self.files_path = TRASH_DIR
-        self.info_path = TRASH_INFO_DIR
-        self.can_scan = True
-        self.timeout = None
+    return path
 
-    def start(self, timeout=500):
-        self.stop()
-        GObject.idle_add(self.scan)
-        self.timeout = GObject.timeout_add(timeout, self.scan)
 
-    def stop(self):
-        if self.timeout is None:
-            return
+def get_top_trash(top, create=False):
+    """
+    Returns the trash folder of the user in the mount of top, from the trash
+    specification: $top/.Trash/$uid if $top/.Trash is a folder with the
+    sticky bit (and not a link), else $top/.Trash-$uid. It returns None if
+    there is no trash, and if create is True, if it can not be created.
+    """
 
-        GObject.source_remove(self.timeout)
-        self.files = {}
-        self.timeout = None
+    uid = str(os.getuid())
+    admin = os.path.join(top, '.Trash')
+    trashes = [os.path.join(top, '.Trash-' + uid)]
 
-    def move_to(self, paths):
-        readable1, writable1 = get_access(self.files_path)
-        readable2, writable2 = get_access(self.info_path)
+    try:
+        info = os.lstat(admin)
+        if stat.S_ISDIR(info.st_mode) and info.st_mode & stat.S_ISVTX:
+            trashes.insert(0, os.path.join(admin, uid))
 
-        if not writable1 or not writable2:
-            #self.emit('error')
-            return
+    except OSError:
+        pass
 
-        for path in paths:
-            readable, writable = get_access(path)
-            name = get_name(path)
-            new_path = os.path.join(self.files_path, name)
-            info_path = os.path.join(self.info_path, name) + '.trashinfo'
+    for trash in trashes:
+        if os.path.isdir(os.path.join(trash, 'info')) and \
+                not os.path.islink(trash):
+            return trash
 
-            if not writable:
-                #self.emit('error')
-                continue
+        if not create:
+            continue
 
-            os.rename(path, new_path)
+        try:
+            if not os.path.isdir(trash):
+                os.mkdir(trash, 0700)
 
-            info_file = open(info_path, 'w')
-            cfg = ConfigParser.ConfigParser()
+            for name in ['files', 'info']:
+                if not os.path.isdir(os.path.join(trash, name)):
+                    os.mkdir(os.path.join(trash, name), 0700)
 
-            cfg.add_section('Trash Info')
-            cfg.set('Trash Info', 'Path', path)
-            cfg.set('Trash Info', 'DeletionDate', get_current_time())
-            cfg.write(info_file)
-            info_file.close()
+            return trash
 
-    def remove_paths(self, paths):
-        for path in paths:
-            name = get_name(path)
-            info_path = os.path.join(self.info_path, name) + '.trashinfo'
-            if os.path.isdir(path):
-                os.removedirs(path)
+        except OSError:
+            continue
 
-            elif os.path.isfile(path):
-                os.remove(path)
+    return None
 
-            os.remove(info_path)
 
-    def clear(self):
-        files = [os.path.join(self.files_path, x) \
-                for x in os.listdir(self.files_path)]
+def same_device(path, folder):
+    try:
+        return os.lstat(path).st_dev == os.stat(folder).st_dev
 
-        self.purge(files)
+    except OSError:
+        return False
 
-    def restore(self, paths):
-        for path in paths:
-            name = get_name(path)
-            info_path = os.path.join(self.info_path, name) + '.trashinfo'
-            cfg = ConfigParser.ConfigParser()
-            cfg.read([info_path])
-            if cfg.has_section('Trash Info'):
-                if cfg.has_option('Trash Info', 'Path'):
-                    save_path = cfg.get('Trash Info', 'Path')
 
-                else:
-                    # self.emit('error')
-                    continue
+def syncfs(path):
+    # Writes to the device all the data of the file system of path
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc is not None and hasattr(libc, 'syncfs'):
+            if libc.syncfs(fd) < 0:
+                number = ctypes.get_errno()
+                raise OSError(number, os.strerror(number))
 
-            else:
-                # self.emit('error')
-                continue
+        elif libc is not None and hasattr(libc, 'sync'):
+            libc.sync()
 
-            parent_directory = get_parent_directory(save_path)
-            readable, writable = get_access(parent_directory)
-            if not writable:
-                # self.emit('error')
-                continue
+        else:
+            os.fsync(fd)
 
-            os.rename(path, save_path)
+    finally:
+        os.close(fd)
 
-    def scan(self):
-        files = {}
 
-        for path in [self.files_path, self.info_path]:
-            if not os.path.isdir(path):
-                try:
-                    os.makedirs(path)
+def sync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
 
-                except:
-                    print 'error creating %s' % self.files_path
-                    return False
+    finally:
+        os.close(fd)
 
-        for name in os.listdir(self.info_path):
-            if not name.endswith('.trashinfo'):
-                continue
 
-            info_path = os.path.join(self.info_path, name)
-            real_file = os.path.join(self.files_path, name[:-10])
+def remove_path(path, ignore_errors=False):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors)
 
-            cfg = ConfigParser.ConfigParser()
-            cfg.read([info_path])
+        else:
+            os.remove(path)
 
-            if cfg.has_section('Trash Info'):
-                if cfg.has_option('Trash Info', 'Path'):
-                    path = clear_path(cfg.get('Trash Info', 'Path'))
-                    files[info_path] = {'path': clear_path(path),
-                                        'real-file': clear_path(real_file)}
+    except OSError:
+        if not ignore_errors:
+            raise
 
-                    if cfg.has_option('Trash Info', 'DeletionDate'):
-                        deletion_date = cfg.get('Trash Info', 'DeletionDate')
-                        files[info_path]['deletion-date'] = deletion_date
 
-        if files != self.files:
-            self.files = files
-            self.emit('files-changed', files)
+def get_copy_name(path):
+    if not os.path.lexists(path):
+        return path
 
-        return True
+    folder, name = os.path.split(path)
+    name, extension = os.path.splitext(name)
+    number = 1
+    while os.path.lexists(path):
+        copy = _('copy') if number == 1 else _('copy %d') % number
+        path = os.path.join(folder, '%s (%s)%s' % (name, copy, extension))
+        number += 1
+
+    return path
 
 
 def get_pixbuf_from_path(path, size=None):
@@ -815,6 +3907,38 @@ def get_size_unit(num):
             num /= 1024.0
 
 
+def get_time_text(seconds):
+    seconds = int(seconds)
+    hours, minutes = seconds / 3600, seconds / 60 % 60
+    if hours:
+        return '%d:%02d:%02d' % (hours, minutes, seconds % 60)
+
+    return '%d:%02d' % (minutes, seconds % 60)
+
+
+def get_path_size(path):
+    # Returns (True, number of items) for folders and (False, bytes) for
+    # files, or None if the path can not be examinated.
+    try:
+        info = os.stat(path)
+
+    except OSError:
+        return None
+
+    if stat.S_ISDIR(info.st_mode):
+        readable, writable = get_access(path)
+        try:
+            return True, len(os.listdir(path)) if readable else 0
+
+        except OSError:
+            return True, 0
+
+    elif stat.S_ISREG(info.st_mode):
+        return False, info.st_size
+
+    return None
+
+
 def get_size(paths):
     if type(paths) == str:
         readable, writable = get_access(paths)
@@ -825,23 +3949,28 @@ def get_size(paths):
 
     folders = []
     files = []
-    string = ''
     quantity = 0
     size = 0
 
     for x in paths:
-        if os.path.isdir(x):
+        data = get_path_size(x)
+        if data is None:
+            continue
+
+        is_folder, value = data
+        if is_folder:
             folders.append(x)
+            quantity += value
 
-        elif os.path.isfile(x):
+        else:
             files.append(x)
+            size += value
 
-    for x in folders:
-        readable, writable = get_access(x)
-        quantity += len(os.listdir(x)) if readable else 0
+    return format_size(folders, files, quantity, size)
 
-    for x in files:
-        size += os.path.getsize(x)
+
+def format_size(folders, files, quantity, size):
+    string = ''
 
     if len(folders) and len(files):
         if len(folders) > 1:
@@ -928,6 +4057,49 @@ def get_total_size(paths=[]):
     return total_size
 
 
+def walk_tree(path):
+    """
+    Walks the tree of path without following links, yielding (path, path
+    relative to the root, lstat info, None) for each file and folder, the
+    folders before their content. A folder that can not be read, or that
+    was already found (a bind mount inside the tree), yields (path,
+    relative path, None, errno) and its content is skipped.
+    """
+
+    visited = set()
+    stack = [(path, '')]
+
+    while stack:
+        path, relative = stack.pop()
+        try:
+            info = os.lstat(path)
+            names = []
+            if stat.S_ISDIR(info.st_mode):
+                if (info.st_dev, info.st_ino) in visited:
+                    raise OSError(errno.ELOOP, os.strerror(errno.ELOOP))
+
+                visited.add((info.st_dev, info.st_ino))
+                names = sorted(os.listdir(path), reverse=True)
+
+        except OSError as error:
+            yield path, relative, None, error.errno
+            continue
+
+        yield path, relative, info, None
+        stack.extend([(os.path.join(path, name),
+                       os.path.join(relative, name)) for name in names])
+
+
+def get_free_space(path):
+    # The bytes that a user without privileges can write in the device
+    try:
+        info = os.statvfs(path)
+        return info.f_bavail * info.f_frsize
+
+    except OSError:
+        return float('inf')
+
+
 def get_type(path):
     unknown = 'application/octet-stream'
     path = path.replace(' ', '\ ')
@@ -949,7 +4121,13 @@ def get_type(path):
 
 
 def get_simple_type(path):
-    _type = get_type(path)
+    if os.path.islink(path):
+        return _('Link')
+
+    return get_simple_mime_type(get_type(path))
+
+
+def get_simple_mime_type(_type):
     simple_types = {'application/octet-stream': _('Unknown'),
                     'inode/mount-point': _('Folder'),
                     'inode/directory': _('Folder'),
@@ -960,9 +4138,6 @@ def get_simple_type(path):
                     'application/zip': _('File')}
 
     _return = simple_types.get(_type, False) or _type
-    if os.path.islink(path):
-        return _('Link')
-
     if _return == _type:
         if 'text' in _return:
             _return = _('Text')
@@ -991,6 +4166,39 @@ def get_simple_modified_time(path):
     return get_modified_time(path)
 
 
+def get_path_info(path):
+    # Returns (stat info, True if path is a link) or None if the path does
+    # not exist, the links are followed like os.path.isdir does.
+    try:
+        info = os.lstat(path)
+        is_link = stat.S_ISLNK(info.st_mode)
+        if is_link:
+            info = os.stat(path)
+
+    except OSError:
+        return None
+
+    return info, is_link
+
+
+def get_details(path, info, is_link=False):
+    # The size, type and modified time columns made from the stat info of
+    # the listing, only the name of the file is used to guess its type.
+    if stat.S_ISDIR(info.st_mode):
+        size = ''
+        _type = _('Folder')
+
+    else:
+        size = get_size_unit(info.st_size)
+        _type = get_simple_mime_type(
+            Gio.content_type_guess(path, data=None)[0])
+
+    if is_link:
+        _type = _('Link')
+
+    return [size, _type, time.ctime(info.st_mtime)]
+
+
 def get_current_time():
     t = datetime.datetime.now()
     month = ('0' + str(t.month)) if len(str(t.month)) == 1 else t.month
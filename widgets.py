@@ -19,12 +19,14 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import stat
 import globals as G
 from gettext import gettext as _
 
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import Gio
+from gi.repository import GLib
 from gi.repository import Pango
 from gi.repository import GObject
 from gi.repository import GdkPixbuf
@@ -115,6 +117,102 @@ class SearchEntry(Gtk.Window):
             self.emit('select')
 
 
+class FuzzyFinder(SearchEntry):
+    """
+    A SearchEntry that shows the paths that best match its text, used to
+    jump quickly to a file or folder.
+    """
+
+    __gsignals__ = {
+        'item-selected': (GObject.SIGNAL_RUN_FIRST, None, [str]),
+        }
+
+    def __init__(self):
+        SearchEntry.__init__(self)
+
+        self.width = 400
+        self.folder = ''
+        self.matcher = G.FuzzyMatcher()
+        self.model = Gtk.ListStore(str, str)
+        self.treeview = Gtk.TreeView(self.model)
+        self.treeview.set_headers_visible(False)
+        self.treeview.set_can_focus(False)
+        self.treeview.append_column(
+            Gtk.TreeViewColumn('Path', Gtk.CellRendererText(), text=0))
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_size_request(self.width, 300)
+        scrolled.add(self.treeview)
+
+        self.remove(self.entry)
+        self.entry.set_size_request(self.width, self.height)
+
+        vbox = Gtk.VBox()
+        vbox.pack_start(self.entry, False, False, 0)
+        vbox.pack_start(scrolled, True, True, 0)
+        self.add(vbox)
+
+        self.connect('search-changed', self.__search_changed_cb)
+        self.connect('select', self.__select_cb)
+        self.entry.connect('changed', self.__entry_changed_cb)
+        self.entry.connect('key-press-event', self.__move_cursor_cb)
+        self.treeview.connect('row-activated', self.__row_activated_cb)
+
+        self.show_all()
+
+    def set_paths(self, paths, folder):
+        self.folder = folder.rstrip('/') + '/'
+        self.matcher.set_paths(paths, folder)
+
+    def reset_timeout(self):
+        # The finder stays open until it loses the focus.
+        pass
+
+    def _show(self, text):
+        self.model.clear()
+        SearchEntry._show(self, text)
+        if not text:
+            self.__search_changed_cb(self, '')
+
+    def __entry_changed_cb(self, entry):
+        # SearchEntry does not emit search-changed for an empty text
+        if not entry.get_text():
+            self.__search_changed_cb(self, '')
+
+    def __search_changed_cb(self, finder, text):
+        self.model.clear()
+        for path in self.matcher.search(text):
+            name = path
+            if path.startswith(self.folder):
+                name = path[len(self.folder):]
+
+            self.model.append([name, path])
+
+        if len(self.model):
+            self.treeview.set_cursor(Gtk.TreePath(0), None, False)
+
+    def __move_cursor_cb(self, widget, event):
+        key = G.KEYS.get(event.keyval, None)
+        if key not in ['Up', 'Down'] or not len(self.model):
+            return False
+
+        treepath, column = self.treeview.get_cursor()
+        idx = treepath.get_indices()[0] if treepath else -1
+        idx += 1 if key == 'Down' else -1
+        idx = max(0, min(idx, len(self.model) - 1))
+        self.treeview.set_cursor(Gtk.TreePath(idx), None, False)
+        return True
+
+    def __select_cb(self, finder):
+        treepath, column = self.treeview.get_cursor()
+        if treepath:
+            self.emit('item-selected', self.model[treepath][1])
+
+    def __row_activated_cb(self, treeview, treepath, column):
+        self.hide()
+        self.emit('item-selected', self.model[treepath][1])
+
+
 class View(Gtk.VBox):
 
     __gsignals__ = {
@@ -138,6 +236,12 @@ class View(Gtk.VBox):
         self.history = []
         self.folders = []
         self.files = []
+        self.infos = {}  # {path: (stat info, is link)} from the listing
+        self.rows = {}  # {path: row number in self.model}
+        self.paths = []  # Row number -> path
+        self.selected = []
+        self.name_index = G.NameIndex()
+        self._save_selection = True
         self.folder = folder
         self.icon_size = G.DEFAULT_ICON_SIZE
         self.dirs = G.Dirs()
@@ -145,29 +249,105 @@ class View(Gtk.VBox):
         self.sort = G.SORT_BY_NAME
         self.reverse = False
         self.activation = G.ACTIVATION_WITH_TWO_CLICKS
+        self.mode = None
+        self.view = None
+        self.selection = None
+        self.results = False  # True when the view shows search results
+        self.search = None
         self.__scrolled = Gtk.ScrolledWindow()
 
-        if view_mode == G.MODE_ICONS:
+        # The same model is used by the icons and the list modes, so change
+        # the mode don't need list the folder again.
+        self.model = Gtk.ListStore(
+            str, GdkPixbuf.Pixbuf, str, str, str, str, str)
+        # Name, Icon, Size, Type, Modified, Path, Tooltip
+
+        self.set_view_mode(view_mode)
+        self.add(self.__scrolled)
+
+    def set_view_mode(self, mode):
+        if mode == self.mode:
+            return
+
+        self.mode = mode
+        if self.view:
+            self.__scrolled.remove(self.view)
+
+        if mode == G.MODE_ICONS:
             self.__make_icon_view()
 
-        elif view_mode == G.MODE_LIST:
+        elif mode == G.MODE_LIST:
             self.__make_list_view()
 
-        self.add(self.__scrolled)
+        self.view.show_all()
+        self.restore_selection()
+
+    def get_path_from_treepath(self, treepath):
+        return self.paths[treepath.get_indices()[0]]
+
+    def get_selected_paths(self):
+        return list(self.selected)
+
+    def get_title(self):
+        if self.results:
+            if self.search:
+                return '%s: %s' % (_('Search'), self.search.text)
+
+            return _('Search')
+
+        return self.dirs[self.folder]
+
+    def clear_model(self):
+        # Clearing the model emits selection changes, but the selection must
+        # survive until the new rows are added.
+        self._save_selection = False
+        self.rows = {}
+        self.paths = []
+        self.model.clear()
+
+    def append_row(self, path, row):
+        self.rows[path] = len(self.paths)
+        self.paths.append(path)
+        self.model.append(row)
 
-    def get_path_from_treeiter(self, treeiter):
-        name = self.model.get_value(treeiter, 0)
-        directory = os.path.join(self.folder, name)
+    def select_all(self):
+        if self.mode == G.MODE_ICONS:
+            self.view.select_all()
+
+        elif self.mode == G.MODE_LIST:
+            self.selection.select_all()
 
-        if name == G.HOME_NAME:
-            directory = G.HOME_DIR
+    def select_path(self, path):
+        self._unselect_all()
+        if path in self.rows:
+            self._select_treepath(Gtk.TreePath(self.rows[path]))
 
-        return G.clear_path(directory)
+    def update_name_index(self):
+        self.name_index.update(self.paths, lambda path: self.dirs[path])
+
+    def restore_selection(self):
+        self._save_selection = False
+        for path in self.selected:
+            if path in self.rows:
+                self._select_treepath(Gtk.TreePath(self.rows[path]))
+
+        self._save_selection = True
+        self.selected = [path for path in self.selected if path in self.rows]
+        self.emit('selection-changed', self.get_selected_paths())
 
     def set_icon_size(self, icon_size):
-        if icon_size != self.icon_size:
-            GObject.idle_add(self.model.clear)
-            self.icon_size = icon_size
+        if icon_size == self.icon_size:
+            return
+
+        self.icon_size = icon_size
+        if self.results:
+            paths = self.paths
+            self.clear_model()
+            self.add_paths(paths)
+            self.restore_selection()
+
+        else:
+            GObject.idle_add(self.clear_model)
             GObject.idle_add(self._show_icons)
 
     def mkdir(self, *args):
@@ -207,183 +387,32 @@ class View(Gtk.VBox):
         self.menu = G.make_menu(paths, self.folder, data)
 
     def show_icons(self, paths):
-        GObject.idle_add(self.model.clear)
+        if self.results:
+            return  # The rows are added with add_paths()
+
+        GObject.idle_add(self.clear_model)
 
         del self.folders
         del self.files
 
         self.folders = []
         self.files = []
+        self.infos = {}
 
         for path in paths:
-            if os.path.isdir(path):
+            data = G.get_path_info(path)
+            if data is None:
+                continue
+
+            self.infos[path] = data
+            if stat.S_ISDIR(data[0].st_mode):
                 self.folders.append(path)
 
-            elif os.path.isfile(path):
+            elif stat.S_ISREG(data[0].st_mode):
                 self.files.append(path)
 
         GObject.idle_add(self._show_icons)
 
-    def __make_icon_view(self):
-        self.model = Gtk.ListStore(str, GdkPixbuf.Pixbuf)
-        self.view = Gtk.IconView()
-
-        self.view.set_text_column(0)
-        self.view.set_pixbuf_column(1)
-        self.view.set_can_focus(True)
-        self.view.set_model(self.model)
-        self.view.set_item_padding(0)
-        self.view.set_selection_mode(Gtk.SelectionMode.MULTIPLE)
-        self.__scrolled.add(self.view)
-
-    def __make_list_view(self):
-        self.model = Gtk.ListStore(GdkPixbuf.Pixbuf, str, str, str, str, str)
-        # Icon, Name, Size, Type, Modified, Path
-
-        self.view = Gtk.TreeView()
-        self.view.set_can_focus(True)
-        self.view.set_model(self.model)
-        self.__scrolled.add(self.view)
-
-        self.selection = self.view.get_selection()
-        self.selection.set_mode(Gtk.SelectionMode.MULTIPLE)
-
-        col_name = Gtk.TreeViewColumn(title=_('Name'))
-        col_name.set_expand(True)
-        col_name.set_sizing(Gtk.TreeViewColumnSizing.AUTOSIZE)
-
-        cell_icon = Gtk.CellRendererPixbuf()
-        cell_text = Gtk.CellRendererText()
-        col_name.pack_start(cell_icon, False)
-        col_name.pack_start(cell_text, True)
-
-        col_name.add_attribute(cell_icon, 'pixbuf', 0)
-        col_name.add_attribute(cell_text, 'text', 1)
-
-        self.view.append_column(col_name)
-
-        number = 2
-        for name in [_('Size'), _('Type'), _('Modified')]:
-            col = Gtk.TreeViewColumn(title=name)
-            cell = Gtk.CellRendererText()
-            col.pack_start(cell, True)
-            col.add_attribute(cell, 'text', number)
-
-            self.view.append_column(col)
-            number += 1
-
-    def __open_from_menu(self, item, new_page=False):
-        paths = self.get_selected_paths()
-
-        if new_page:
-            for path in paths:
-                self.emit('new-page', path)
-
-        elif not new_page:
-            self.emit('item-selected', paths)
-
-    def __rename(self, *args):
-        pass
-
-    def __compress(self, *args):
-        pass
-
-    def __sort_changed(self, item, sort):
-        self.sort = sort
-        self.emit('sort-changed', self.sort)
-
-    def __reverse_changed(self, item):
-        self.reverse = not self.reverse
-        self.emit('reverse-changed', self.reverse)
-
-    def __show_properties(self, item):
-        self.emit('show-properties', self.get_selected_paths())
-
-    def __move_to_trash(self, item):
-        self.emit('move-to-trash', self.get_selected_paths())
-
-    def __remove(self, item):
-        self.emit('remove-files', self.get_selected_paths())
-
-
-class IconView(View):
-
-    def __init__(self, folder):
-        View.__init__(self, G.MODE_ICONS, folder)
-
-        # FIXME: Cuando se abre una nueva pestaña, y se regresa a la inicial,
-        #        se pierde la selección anteriror, hay que guardar los objetos
-        #        seleccionados y volverlos a seleccionar.
-
-        self.view.connect('button-press-event', self.__button_press_event_cb)
-        self.view.connect('selection-changed', self.__selection_changed)
-
-    def get_selected_paths(self):
-        selected = []
-        for path in self.view.get_selected_items():
-            treeiter = self.model.get_iter(path)
-            name = self.model.get_value(treeiter, 0)
-            directory = os.path.join(self.folder, name)
-
-            if name == G.HOME_NAME:
-                directory = G.HOME_DIR
-
-            selected.append(G.clear_path(directory))
-
-        return selected
-
-    def get_selected_paths(self):
-        paths = []
-
-        for path in self.view.get_selected_items():
-            treeiter = self.model.get_iter(path)
-            paths.append(self.get_path_from_treeiter(treeiter))
-
-        return paths
-
-    def select_all(self):
-        self.select_all()
-
-    def __selection_changed(self, view):
-        self.emit('selection-changed', self.get_selected_paths())
-
-    def __button_press_event_cb(self, view, event):
-        path = view.get_path_at_pos(int(event.x), int(event.y))
-        selection = view.get_selected_items()
-        paths = []
-
-        if event.button == 3:
-            if not path in selection:
-                self.view.unselect_all()
-                selection = []
-
-                if path:
-                    self.view.select_path(path)
-                    selection = view.get_selected_items()
-
-            for treepath in selection:
-                treeiter = self.model.get_iter(treepath)
-                paths.append(self.get_path_from_treeiter(treeiter))
-
-            if not paths:
-                paths = [self.folder]
-
-            self.make_menu(paths)
-            self.menu.popup(None, None, None, None, event.button, event.time)
-            return True
-
-        if not path:
-            return
-
-        treeiter = self.model.get_iter(path)
-        directory = self.get_path_from_treeiter(treeiter)
-
-        if event.button == 2:
-            self.emit('new-page', directory)
-
-        if event.button == 1 and event.type.value_name == self.activation:
-            self.emit('item-selected', directory)
-
     def _show_icons(self):
         if self.sort == G.SORT_BY_NAME:
             if self.reverse:
@@ -412,7 +441,7 @@ class IconView(View):
                 _folders[size].append(folder)
 
             for _file in self.files:
-                size = G.get_total_size([_file])
+                size = self.infos[_file][0].st_size
                 if not size in _files:  # User list for files with same size
                     _files[size] = []
 
@@ -442,105 +471,193 @@ class IconView(View):
 
             paths = self.folders + self.files
 
+        self.clear_model()
+
         for path in paths:
             name = self.dirs[path]
             pixbuf = G.get_pixbuf_from_path(path, self.icon_size)
-            self.model.append([name, pixbuf])
+            details = self.__get_details(path)
+            self.append_row(path, [name, pixbuf] + details + [path, None])
 
+        self.update_name_index()
+        self.restore_selection()
+        self.show_all()
 
-class ListView(View):
+    def add_paths(self, paths, tooltips={}):
+        # Adds rows at the end of the view, without sorting them.
+        for path in paths:
+            if path in self.rows:
+                continue
 
-    def __init__(self, folder):
-        View.__init__(self, G.MODE_LIST, folder)
+            name = self.dirs[path]
+            pixbuf = G.get_pixbuf_from_path(path, self.icon_size)
+            details = self.__get_details(path)
 
-        self.selected_paths = []
-        self.view.connect('button-press-event', self.__button_press_event_cb)
-        self.selection.connect('changed', self.__selection_changed_cb)
+            tooltip = tooltips.get(path, None)
+            self.append_row(path, [name, pixbuf] + details + [path, tooltip])
 
-    def get_selected_paths(self):
-        return self.selected_paths
+        self.update_name_index()
 
-    def select_all(self):
-        self.selection.select_all()
+    def add_matches(self, matches):
+        # matches is a list of (path, line number, line), the lines are shown
+        # in the tooltip of each file.
+        tooltips = {}
+        for path, line, text in matches:
+            text = GLib.markup_escape_text('%d: %s' % (line, text))
+            tooltips[path] = tooltips.get(path, []) + [text]
 
-    def _show_icons(self):
-        if self.sort == G.SORT_BY_NAME:
-            if self.reverse:
-                self.folders.sort()
-                self.folders.reverse()
-                self.files.sort()
-                self.files.reverse()
-                paths = self.files + self.folders
+        for path, lines in tooltips.items():
+            if path in self.rows:
+                treeiter = self.model.get_iter(Gtk.TreePath(self.rows[path]))
+                old = self.model.get_value(treeiter, 6)
+                lines = ([old] if old else []) + lines
+                self.model.set_value(treeiter, 6, '\n'.join(lines))
+
+            else:
+                tooltips[path] = '\n'.join(lines)
+
+        self.add_paths([x for x, l, t in matches if not x in self.rows],
+                       tooltips)
+
+    def _select_treepath(self, treepath):
+        if self.mode == G.MODE_ICONS:
+            self.view.select_path(treepath)
+
+        elif self.mode == G.MODE_LIST:
+            self.selection.select_path(treepath)
+
+    def _unselect_all(self):
+        if self.mode == G.MODE_ICONS:
+            self.view.unselect_all()
+
+        elif self.mode == G.MODE_LIST:
+            self.selection.unselect_all()
+
+    def __get_details(self, path):
+        # The search results are not listed, they are examinated once when
+        # they are added.
+        if path not in self.infos:
+            self.infos[path] = G.get_path_info(path)
+
+        if self.infos[path] is None:
+            return ['', '', '']
+
+        info, is_link = self.infos[path]
+        return G.get_details(path, info, is_link)
+
+    def __make_icon_view(self):
+        self.view = Gtk.IconView()
+        self.selection = None
+
+        self.view.set_text_column(0)
+        self.view.set_pixbuf_column(1)
+        self.view.set_tooltip_column(6)
+        self.view.set_can_focus(True)
+        self.view.set_model(self.model)
+        self.view.set_item_padding(0)
+        self.view.set_selection_mode(Gtk.SelectionMode.MULTIPLE)
+        self.__scrolled.add(self.view)
+
+        self.view.connect(
+            'button-press-event', self.__icon_button_press_event_cb)
+        self.view.connect('selection-changed', self.__selection_changed)
+
+    def __make_list_view(self):
+        self.view = Gtk.TreeView()
+        self.view.set_can_focus(True)
+        self.view.set_model(self.model)
+        self.view.set_tooltip_column(6)
+        self.__scrolled.add(self.view)
+
+        self.selection = self.view.get_selection()
+        self.selection.set_mode(Gtk.SelectionMode.MULTIPLE)
+
+        col_name = Gtk.TreeViewColumn(title=_('Name'))
+        col_name.set_expand(True)
+        col_name.set_sizing(Gtk.TreeViewColumnSizing.AUTOSIZE)
+
+        cell_icon = Gtk.CellRendererPixbuf()
+        cell_text = Gtk.CellRendererText()
+        col_name.pack_start(cell_icon, False)
+        col_name.pack_start(cell_text, True)
+
+        col_name.add_attribute(cell_icon, 'pixbuf', 1)
+        col_name.add_attribute(cell_text, 'text', 0)
+
+        self.view.append_column(col_name)
 
-            elif not self.reverse:
-                self.folders.sort()
-                self.files.sort()
-                paths = self.folders + self.files
+        number = 2
+        for name in [_('Size'), _('Type'), _('Modified')]:
+            col = Gtk.TreeViewColumn(title=name)
+            cell = Gtk.CellRendererText()
+            col.pack_start(cell, True)
+            col.add_attribute(cell, 'text', number)
 
-        elif self.sort == G.SORT_BY_SIZE:
-            folders = []
-            _folders = {}
-            files = []
-            _files = {}
+            self.view.append_column(col)
+            number += 1
 
-            for folder in self.folders:
-                size = G.get_total_size([folder])
-                if not size in _folders:  # Use list for folders with same size
-                    _folders[size] = []
+        self.view.connect(
+            'button-press-event', self.__list_button_press_event_cb)
+        self.selection.connect('changed', self.__selection_changed)
 
-                _folders[size].append(folder)
+    def __selection_changed(self, widget):
+        if not self._save_selection:
+            return
 
-            for _file in self.files:
-                size = G.get_total_size([_file])
-                if not size in _files:  # User list for files with same size
-                    _files[size] = []
+        if self.mode == G.MODE_ICONS:
+            treepaths = self.view.get_selected_items()
 
-                _files[size].append(_file)
+        elif self.mode == G.MODE_LIST:
+            model, treepaths = self.selection.get_selected_rows()
 
-            folders_sizes = _folders.keys()
-            folders_sizes.sort()
-            if not self.reverse:
-                folders_sizes.reverse()
+        self.selected = [self.get_path_from_treepath(treepath)
+                         for treepath in treepaths]
 
-            self.folders = []
+        self.emit('selection-changed', self.get_selected_paths())
 
-            for size in folders_sizes:
-                for folder in _folders[size]:
-                    self.folders.append(folder)
+    def __icon_button_press_event_cb(self, view, event):
+        path = view.get_path_at_pos(int(event.x), int(event.y))
+        selection = view.get_selected_items()
+        paths = []
 
-            files_sizes = _files.keys()
-            files_sizes.sort()
-            if not self.reverse:
-                files_sizes.reverse()
+        if event.button == 3:
+            if not path in selection:
+                self.view.unselect_all()
+                selection = []
 
-            self.files = []
+                if path:
+                    self.view.select_path(path)
+                    selection = view.get_selected_items()
 
-            for size in files_sizes:
-                for _file in _files[size]:
-                    self.files.append(_file)
+            for treepath in selection:
+                paths.append(self.get_path_from_treepath(treepath))
 
-            paths = self.folders + self.files
+            if not paths:
+                paths = [self.folder]
 
-        self.model.clear()
+            self.make_menu(paths)
+            self.menu.popup(None, None, None, None, event.button, event.time)
+            return True
 
-        for path in paths:
-            pixbuf = G.get_pixbuf_from_path(path, self.icon_size)
-            name = self.dirs[path]
-            size = G.get_simple_size(path)
-            _type = G.get_simple_type(path)
-            modified = G.get_simple_modified_time(path)
+        if not path:
+            return
 
-            self.model.append([pixbuf, name, size, _type, modified, path])
+        directory = self.get_path_from_treepath(path)
 
-        self.show_all()
+        if event.button == 2:
+            self.emit('new-page', directory)
+
+        if event.button == 1 and event.type.value_name == self.activation:
+            self.emit('item-selected', directory)
 
-    def __button_press_event_cb(self, view, event):
+    def __list_button_press_event_cb(self, view, event):
         data = view.get_path_at_pos(int(event.x), int(event.y))
         treepath = data[0] if data else None
-        treeiter = self.model.get_iter(treepath) if treepath else None
-        path = self.model.get_value(treeiter, 5) if treeiter else self.folder
+        path = self.folder
+        if treepath:
+            path = self.get_path_from_treepath(treepath)
 
-        if self.selected_paths:
+        if self.selected:
             if event.button == 1 and event.type.value_name == self.activation:
                 self.emit('item-selected', path)
 
@@ -548,33 +665,46 @@ class ListView(View):
                 self.emit('new-page', path)
 
         if event.button == 3:
-            if not path in self.selected_paths and bool(treepath):
+            if not path in self.selected and bool(treepath):
                 self.selection.unselect_all()
-                self.selection.select_iter(treeiter)
+                self.selection.select_path(treepath)
 
-            self.make_menu(
-                self.selected_paths if self.selected_paths else [self.folder])
+            self.make_menu(self.selected if self.selected else [self.folder])
             self.menu.popup(None, None, None, None, event.button, event.time)
             return True
 
-    def __selection_changed_cb(self, selection):
-        del self.selected_paths
-        self.selected_paths = []
-        model, treepaths = self.selection.get_selected_rows()
-
-        for treepath in treepaths:
-            treeiter = model.get_iter(treepath)
-            self.selected_paths.append(model.get_value(treeiter, 5))
-
-        self.emit('selection-changed', self.selected_paths)
-
     def __open_from_menu(self, item, new_page=False):
+        paths = self.get_selected_paths()
+
         if new_page:
-            for path in self.selected_paths:
+            for path in paths:
                 self.emit('new-page', path)
 
         elif not new_page:
-            self.emit('item-selected', self.selected_paths)
+            self.emit('item-selected', paths)
+
+    def __rename(self, *args):
+        pass
+
+    def __compress(self, *args):
+        pass
+
+    def __sort_changed(self, item, sort):
+        self.sort = sort
+        self.emit('sort-changed', self.sort)
+
+    def __reverse_changed(self, item):
+        self.reverse = not self.reverse
+        self.emit('reverse-changed', self.reverse)
+
+    def __show_properties(self, item):
+        self.emit('show-properties', self.get_selected_paths())
+
+    def __move_to_trash(self, item):
+        self.emit('move-to-trash', self.get_selected_paths())
+
+    def __remove(self, item):
+        self.emit('remove-files', self.get_selected_paths())
 
 
 class InfoBar(Gtk.InfoBar):
@@ -620,6 +750,10 @@ class InfoBar(Gtk.InfoBar):
             self.title.set_label(G.TITLE_ERROR_NOT_EXISTS)
             self.msg.set_label(G.MSG_NOT_EXISTS.replace('@', info))
 
+        elif msg_type == G.ERROR_INVALID_PATTERN:
+            self.title.set_label(G.TITLE_ERROR_INVALID_PATTERN)
+            self.msg.set_label(G.MSG_INVALID_PATTERN.replace('@', info))
+
     def __hide(self, widget, response=None):
         GObject.idle_add(self.hide)
 
@@ -665,6 +799,82 @@ class MkdirInfoBar(Gtk.InfoBar):
         self.entry.grab_focus()
 
 
+class SearchInfoBar(Gtk.InfoBar):
+
+    __gsignals__ = {
+        'search': (GObject.SIGNAL_RUN_FIRST, None,
+                   [str, int, bool, bool, int]),
+        'stop': (GObject.SIGNAL_RUN_FIRST, None, []),
+        }
+
+    def __init__(self):
+        Gtk.InfoBar.__init__(self)
+
+        self.set_show_close_button(True)
+        self.set_message_type(Gtk.MessageType.QUESTION)
+
+        hbox = Gtk.HBox()
+        hbox.set_spacing(5)
+
+        self.entry = Gtk.SearchEntry()
+        self.entry.set_placeholder_text(_('Search files by name'))
+        self.entry.connect('activate', self.__search)
+        hbox.pack_start(self.entry, True, True, 0)
+
+        self.combo = Gtk.ComboBoxText()
+        # Same order that G.SEARCH_SUBSTRING, G.SEARCH_GLOB and G.SEARCH_REGEX
+        self.combo.append_text(_('Name contains'))
+        self.combo.append_text(_('Glob pattern'))
+        self.combo.append_text(_('Regular expression'))
+        self.combo.set_active(G.SEARCH_SUBSTRING)
+        hbox.pack_start(self.combo, False, False, 0)
+
+        self.check_content = Gtk.CheckButton(_('Search inside files'))
+        hbox.pack_start(self.check_content, False, False, 0)
+
+        self.check_devices = Gtk.CheckButton(_('Search in other devices'))
+        hbox.pack_start(self.check_devices, False, False, 0)
+
+        hbox.pack_start(Gtk.Label(_('Depth')), False, False, 0)
+
+        self.spin_depth = Gtk.SpinButton.new_with_range(0, 100, 1)
+        self.spin_depth.set_tooltip_text(_('0 for no limit'))
+        hbox.pack_start(self.spin_depth, False, False, 0)
+
+        # The content search has not a depth limit
+        self.check_content.connect(
+            'toggled', lambda b: self.spin_depth.set_sensitive(
+                not b.get_active()))
+
+        self.button_stop = Gtk.Button(_('Stop'))
+        self.button_stop.set_sensitive(False)
+        self.button_stop.connect('clicked', lambda b: self.emit('stop'))
+        hbox.pack_start(self.button_stop, False, False, 0)
+
+        self.connect('response', self.__response_cb)
+        self.connect('realize', self.__realize_cb)
+
+        self.get_content_area().add(hbox)
+        self.show_all()
+
+    def set_searching(self, searching):
+        self.button_stop.set_sensitive(searching)
+
+    def __search(self, entry):
+        if entry.get_text():
+            self.emit('search', entry.get_text(), self.combo.get_active(),
+                      self.check_content.get_active(),
+                      self.check_devices.get_active(),
+                      self.spin_depth.get_value_as_int())
+
+    def __response_cb(self, infobar, response):
+        self.emit('stop')
+        self.hide()
+
+    def __realize_cb(self, widget):
+        self.entry.grab_focus()
+
+
 class TrashInfoBar(Gtk.InfoBar):
 
     __gsignals__ = {
@@ -678,21 +888,58 @@ class TrashInfoBar(Gtk.InfoBar):
         self.add_button(_('Restore'), Gtk.ResponseType.YES)
         self.add_button(Gtk.STOCK_CLEAR, Gtk.ResponseType.APPLY)
 
-        label = Gtk.Label(_('Trash'))
+        self.label = Gtk.Label(_('Trash'))
         box = self.get_content_area()
-        box.add(label)
+        box.add(self.label)
 
         self.set_message_type(Gtk.MessageType.QUESTION)
         self.connect('response', self.__response_cb)
 
+    def set_size(self, count, size):
+        self.label.set_label(_('Trash') + ': ' + _('%d items, %s') % (
+            count, G.get_size_unit(size)))
+
     def __response_cb(self, infobar, response):
         if response == Gtk.ResponseType.YES:
             self.emit('restore')
 
-        elif response == Gtk.ResponseType.QUESTION:
+        elif response == Gtk.ResponseType.APPLY:
             self.emit('clean')
 
 
+class ResumeInfoBar(Gtk.InfoBar):
+
+    __gsignals__ = {
+        'resume': (GObject.SIGNAL_RUN_FIRST, None, []),
+        'discard': (GObject.SIGNAL_RUN_FIRST, None, [])
+        }
+
+    def __init__(self, count):
+        Gtk.InfoBar.__init__(self)
+
+        self.add_button(_('Resume'), Gtk.ResponseType.YES)
+        self.add_button(_('Discard'), Gtk.ResponseType.NO)
+
+        label = Gtk.Label(
+            _('%d file operations were interrupted.') % count)
+
+        box = self.get_content_area()
+        box.add(label)
+
+        self.set_message_type(Gtk.MessageType.QUESTION)
+        self.connect('response', self.__response_cb)
+        self.show_all()
+
+    def __response_cb(self, infobar, response):
+        if response == Gtk.ResponseType.YES:
+            self.emit('resume')
+
+        elif response == Gtk.ResponseType.NO:
+            self.emit('discard')
+
+        self.destroy()
+
+
 class LateralView(Gtk.ScrolledWindow):
 
     __gsignals__ = {
@@ -1163,7 +1410,6 @@ class Notebook(Gtk.Notebook):
     __gsignals__ = {
         'new-page': (GObject.SIGNAL_RUN_FIRST, None, [str]),
         'remove-page': (GObject.SIGNAL_RUN_FIRST, None, [object]),
-        'reconnect-all-views': (GObject.SIGNAL_RUN_FIRST, None, []),
         }
 
     def __init__(self):
@@ -1184,32 +1430,15 @@ class Notebook(Gtk.Notebook):
             return
 
         self.mode = mode
-        folders = []
-        idx = self.get_current_page()
-
         for view in self.get_children():
-            folders.append(view.folder)
-
-        while self.get_children():
-            self.remove(self.get_children()[0])
-
-        for folder in folders:
-            self.create_page_from_path(folder)
-
-        self.set_current_page(idx)
-        self.emit('reconnect-all-views')
+            view.set_view_mode(mode)
 
     def create_page_from_path(self, path):
         eventbox = Gtk.EventBox()
         hbox = Gtk.HBox()
         label = Gtk.Label(G.Dirs()[path])
         button = Gtk.ToolButton.new_from_stock(Gtk.STOCK_CLOSE)
-        if self.mode == G.MODE_ICONS:
-            view = IconView(path)
-
-        elif self.mode == G.MODE_LIST:
-            view = ListView(path)
-
+        view = View(self.mode, path)
         button.connect('clicked', self.__close_page, view)
 
         hbox.pack_start(label, False, False, 10)
@@ -1231,7 +1460,7 @@ class Notebook(Gtk.Notebook):
             eventbox = self.get_tab_label(view)
             hbox = eventbox.get_children()[0]
             label = hbox.get_children()[0]
-            label.set_label(G.Dirs()[view.folder])
+            label.set_label(view.get_title())
 
     def __new_page_without_path(self, *args):
         self.emit('new-page', '')
@@ -1457,8 +1686,13 @@ class StatusBar(Gtk.HBox):
         Gtk.HBox.__init__(self)
 
         self.icon_size = G.DEFAULT_ICON_SIZE / 8
+        self.selected = []
+        self.folder = G.HOME_DIR
         self.set_margin_left(10)
 
+        self.stats = G.SelectionStats()
+        self.stats.connect('changed', self.__stats_changed)
+
         self.label = Gtk.Label(G.HOME_DIR)
         self.label.set_selectable(True)
         self.label.modify_font(Pango.FontDescription('12'))
@@ -1473,18 +1707,15 @@ class StatusBar(Gtk.HBox):
         self.pack_end(self.scale, False, False, 10)
 
     def update_label(self, selected=[], folder=''):
-        label = ''
-        if len(selected) == 0:
-            label += folder
-
-        elif len(selected) == 1:
-            label += selected[0]
+        self.selected = selected
+        self.folder = folder
 
-        label += ' ' + G.get_size(selected)
-        if not label.replace(' ', ''):
-            label = folder
+        self.stats.set_selection(selected)
+        if not selected:
+            self.label.set_label(folder)
 
-        self.label.set_label(label)
+    def refresh(self):
+        self.stats.refresh()
 
     def aument(self):
         value = self.scale.get_value()
@@ -1502,6 +1733,20 @@ class StatusBar(Gtk.HBox):
 
         self.scale.set_value(value)
 
+    def __stats_changed(self, stats, size):
+        label = ''
+        if len(self.selected) == 0:
+            label += self.folder
+
+        elif len(self.selected) == 1:
+            label += self.selected[0]
+
+        label += ' ' + size
+        if not label.replace(' ', ''):
+            label = self.folder
+
+        self.label.set_label(label)
+
     def __value_changed(self, widget):
         value = int(widget.get_value())
         if value != self.icon_size:
@@ -1692,44 +1937,266 @@ class ProgressWindow(Gtk.Window):
         self.box = Gtk.ListBox()
         self.box.set_selection_mode(Gtk.SelectionMode.NONE)
 
+        self.set_title(_('File operations'))
+        self.set_default_size(450, -1)
+        self.connect('delete-event', self.__delete_event_cb)
+
         self.manager = ccpmanager
         self.manager.connect('progress-changed', self.__progress_changed)
         self.manager.connect('end', self.__operation_ended)
+        self.manager.connect('queue-changed', self.__queue_changed)
+
+        vbox = Gtk.VBox()
+        self.add(vbox)
+
+        hbox = Gtk.HBox()
+        hbox.set_spacing(5)
+        hbox.set_border_width(5)
+        hbox.pack_start(Gtk.Label(_('Limit for all (MB/s, 0 = none):')),
+                        False, False, 0)
+
+        spin = self.__make_rate_spin(None)
+        hbox.pack_start(spin, False, False, 0)
+        vbox.pack_start(hbox, False, False, 0)
 
         scrolled = Gtk.ScrolledWindow()
+        scrolled.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        scrolled.set_min_content_height(100)
         scrolled.add(self.box)
-        self.add(scrolled)
+        vbox.pack_start(scrolled, True, True, 0)
+
+    def __make_rate_spin(self, time_id):
+        spin = Gtk.SpinButton.new_with_range(0, 100000, 1)
+        spin.set_value(self.manager.get_rate_limit(time_id) / 1024 ** 2)
+        spin.connect('value-changed', self.__rate_changed, time_id)
+        return spin
 
     def add_operation(self, time_id):
-        min_value = 0
-        max_value = self.maganer[time_id]['total-size']
-        value = self.manager[time_id]['progress']
+        operation = self.manager[time_id]
+        if operation['action'] == G.CUT:
+            title = _('Moving to "%s"')
+
+        elif operation['action'] == G.REMOVE:
+            title = _('Emptying "%s"')
+
+        else:
+            title = _('Copying to "%s"')
 
         row = Gtk.ListBoxRow()
-        box = Gtk.HBox()
+        hbox = Gtk.HBox()
         hbox.set_spacing(5)
+        hbox.set_border_width(5)
 
-        levelbar = Gtk.LevelBar()
-        levelbar.set_min_value(min_value)
-        levelbar.set_max_value(max_value)
-        levelbar.set_value(value)
+        vbox = Gtk.VBox()
+        vbox.set_spacing(2)
+        hbox.pack_start(vbox, True, True, 0)
 
-        button = Gtk.ToolButton.new_from_stock(Gtk.STOCK_CANCEL)
+        label = Gtk.Label(title % G.get_name(operation['destination']))
+        label.modify_font(Pango.FontDescription('Bold'))
+        label.set_ellipsize(Pango.EllipsizeMode.END)
+        label.set_halign(Gtk.Align.START)
+        vbox.pack_start(label, False, False, 0)
 
-        hbox.pack_start(levelbar, True, True, 0)
-        hbox.pack_start(button, False, False, 0)
-        row.add(hbox)
+        progressbar = Gtk.ProgressBar()
+        vbox.pack_start(progressbar, False, False, 0)
+
+        details = Gtk.Label()
+        details.set_ellipsize(Pango.EllipsizeMode.END)
+        details.set_halign(Gtk.Align.START)
+        vbox.pack_start(details, False, False, 0)
+
+        options = Gtk.HBox()
+        options.set_spacing(5)
+        options.pack_start(Gtk.Label(_('Limit (MB/s):')), False, False, 0)
+        options.pack_start(self.__make_rate_spin(time_id), False, False, 0)
+
+        check_idle = Gtk.CheckButton(_('Low priority'))
+        check_idle.set_active(operation['idle'])
+        check_idle.connect('toggled', self.__idle_toggled, time_id)
+        options.pack_start(check_idle, False, False, 0)
+        vbox.pack_start(options, False, False, 0)
+
+        current = Gtk.Label()
+        current.set_ellipsize(Pango.EllipsizeMode.MIDDLE)
+        current.set_halign(Gtk.Align.START)
+        vbox.pack_start(current, False, False, 0)
+
+        errors_label = Gtk.Label()
+        errors_label.set_selectable(True)
+        errors_label.set_halign(Gtk.Align.START)
+
+        errors = Gtk.Expander()
+        errors.add(errors_label)
+        errors.set_no_show_all(True)
+        vbox.pack_start(errors, False, False, 0)
+
+        button_up = Gtk.ToolButton.new_from_stock(Gtk.STOCK_GO_UP)
+        button_up.set_tooltip_text(_('Move up in the queue'))
+        button_up.connect('clicked', self.__move, time_id, -1)
+        hbox.pack_start(button_up, False, False, 0)
+
+        button_down = Gtk.ToolButton.new_from_stock(Gtk.STOCK_GO_DOWN)
+        button_down.set_tooltip_text(_('Move down in the queue'))
+        button_down.connect('clicked', self.__move, time_id, 1)
+        hbox.pack_start(button_down, False, False, 0)
+
+        button_pause = Gtk.ToolButton.new_from_stock(Gtk.STOCK_MEDIA_PAUSE)
+        button_pause.connect('clicked', self.__pause_or_resume, time_id)
+        hbox.pack_start(button_pause, False, False, 0)
 
-        self.listbox.add(row)
-        self.listbox.show_all()
+        button = Gtk.ToolButton.new_from_stock(Gtk.STOCK_CANCEL)
+        button.connect('clicked', self.__cancel, time_id)
+        hbox.pack_start(button, False, False, 0)
 
-        self.operations[time_id] = {'levelbar': levelbar,
+        row.add(hbox)
+        self.box.add(row)
+
+        self.operations[time_id] = {'progressbar': progressbar,
+                                    'details': details,
+                                    'current': current,
+                                    'errors': errors,
+                                    'errors-label': errors_label,
+                                    'ended': False,
+                                    'button-up': button_up,
+                                    'button-down': button_down,
+                                    'button-pause': button_pause,
                                     'button': button,
                                     'row': row}
 
+        self.__progress_changed(self.manager, time_id)
+        self.show_all()
+        self.__queue_changed(self.manager)
+
     def __progress_changed(self, manager, time_id):
-        progress = self.manager[time_id]['progress']
-        self.operations[time_id]['levelbar'].set_value(progress)
+        if time_id not in self.operations:
+            return
+
+        operation = self.manager[time_id]
+        widgets = self.operations[time_id]
+
+        if operation['total-size']:
+            fraction = operation['progress'] / float(operation['total-size'])
+
+        elif operation['total-files']:
+            fraction = operation['done-files'] / \
+                float(operation['total-files'])
+
+        else:
+            fraction = 0
+
+        details = _('%s of %s, %d of %d files') % (
+            G.get_size_unit(operation['progress']),
+            G.get_size_unit(operation['total-size']),
+            operation['done-files'], operation['total-files'])
+
+        if operation['speed']:
+            details += ', %s/s' % G.get_size_unit(operation['speed'])
+
+        if operation['eta'] is not None:
+            details += ', ' + _('%s left') % G.get_time_text(operation['eta'])
+
+        if operation['conflicts']:
+            details += ', ' + _('%d renamed') % len(operation['conflicts'])
+
+        strategies = sorted(set([G.COPY_STRATEGIES[x]
+                                 for x in operation['strategies']]))
+        strategies.append(G.DURABILITY_NAMES[operation['durability']])
+        details += ' (%s)' % ', '.join(strategies)
+
+        if operation['paused']:
+            details = _('Paused') + ', ' + details
+
+        elif time_id in self.manager.queue:
+            details = _('Waiting') + ', ' + details
+
+        widgets['progressbar'].set_fraction(min(fraction, 1))
+        widgets['details'].set_label(details)
+        widgets['current'].set_label(operation['current-file'] or '')
+
+        errors = operation['errors']
+        if errors:
+            widgets['errors'].set_label(_('%d errors') % len(errors))
+            widgets['errors-label'].set_label('\n'.join(
+                ['%s: %s' % error for error in errors[-100:]]))
+
+            widgets['errors'].show()
+            widgets['errors-label'].show()
+
+    def __queue_changed(self, manager):
+        # The running operations first, then the queue in order
+        order = self.manager.running + self.manager.queue
+        order = [x for x in order if x in self.operations]
+        for idx, time_id in enumerate(order):
+            widgets = self.operations[time_id]
+            if self.box.get_row_at_index(idx) != widgets['row']:
+                self.box.remove(widgets['row'])
+                self.box.insert(widgets['row'], idx)
+
+            queued = time_id in self.manager.queue
+            widgets['button-up'].set_sensitive(
+                queued and self.manager.queue.index(time_id) > 0)
+            widgets['button-down'].set_sensitive(
+                queued and time_id != self.manager.queue[-1])
+
+            if self.manager[time_id]['paused']:
+                widgets['button-pause'].set_stock_id(Gtk.STOCK_MEDIA_PLAY)
+
+            else:
+                widgets['button-pause'].set_stock_id(Gtk.STOCK_MEDIA_PAUSE)
+
+            self.__progress_changed(self.manager, time_id)
+
+    def __rate_changed(self, spin, time_id):
+        rate = int(spin.get_value() * 1024 ** 2)
+        self.manager.set_rate_limit(rate, time_id)
+
+    def __idle_toggled(self, button, time_id):
+        self.manager.set_idle_priority(time_id, button.get_active())
+
+    def __move(self, button, time_id, offset):
+        self.manager.move_operation(time_id, offset)
+
+    def __pause_or_resume(self, button, time_id):
+        if self.manager[time_id]['paused']:
+            self.manager.resume_operation(time_id)
+
+        else:
+            self.manager.pause_operation(time_id)
+
+    def __cancel(self, button, time_id):
+        if self.operations[time_id]['ended']:
+            self.__remove_operation(time_id)
+            return
+
+        button.set_sensitive(False)
+        self.manager.cancel_operation(time_id)
 
     def __operation_ended(self, manager, time_id):
+        if time_id not in self.operations:
+            return
+
+        widgets = self.operations[time_id]
+        if not self.manager[time_id]['errors']:
+            self.__remove_operation(time_id)
+            return
+
+        # The row stays until the user reads the errors
+        self.__progress_changed(manager, time_id)
+        widgets['ended'] = True
+        widgets['button-up'].hide()
+        widgets['button-down'].hide()
+        widgets['button-pause'].hide()
+        widgets['button'].set_stock_id(Gtk.STOCK_CLOSE)
+        widgets['button'].set_sensitive(True)
+
+    def __remove_operation(self, time_id):
         self.box.remove(self.operations[time_id]['row'])
+        del self.operations[time_id]
+
+        if not self.operations:
+            self.hide()
+
+    def __delete_event_cb(self, window, event):
+        # The operations continue in background
+        self.hide()
+        return True